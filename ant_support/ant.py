@@ -1,8 +1,11 @@
 #!/usr/bin/python
 
+from __future__ import print_function
+
 import serial
 import sys
 import time
+from functools import reduce
 
 ANT_Version = 0x3e
 ANT_Capabilities = 0x54
@@ -66,14 +69,155 @@ class AntTransferRxFailedException(AntException): pass
 class AntChecksumException(AntException): pass
 
 
+class AntFramer:
+    """Splits the byte stream from the ANT device into frames.
+
+    Reads whatever the port has waiting into a fixed buffer in one call, and
+    hands out checksum-verified frames as memoryview slices of that buffer.
+    A frame is only valid until the next call on the framer."""
+
+    SYNC = b'\xa4'
+
+    def __init__(self, port, size=1024):
+        self.port = port
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.sync_losses = 0
+        self.checksum_errors = 0
+
+    def buffered(self):
+        return self.end - self.start
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def fill(self):
+        "reads at least one byte, blocking for at most the port timeout"
+        if self.end == len(self.buffer):
+            self.compact()
+        space = len(self.buffer) - self.end
+        data = self.port.read(min(max(self.port.inWaiting(), 1), space))
+        if not data:
+            raise AntNoDataException
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def compact(self):
+        "moves the unread bytes to the front, the buffer itself never changes size"
+        n = self.end - self.start
+        self.buffer[0:n] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = n
+
+    def read_byte(self):
+        if self.start == self.end:
+            self.reset()
+            self.fill()
+        b = self.buffer[self.start]
+        self.start += 1
+        return b
+
+    def next_frame(self, syncprint=''):
+        """Returns the next good frame as a memoryview of message id and data.
+        Raises AntChecksumException for a bad one, having skipped it."""
+        while 1:
+            if self.start < self.end and self.buffer[self.start] != 0xa4:
+                sync = self.buffer.find(self.SYNC, self.start, self.end)
+                if sync < 0:
+                    sync = self.end
+                lost = self.buffer[self.start:sync]
+                if lost.strip(b'\0'):  # zero padding between frames is fine
+                    self.sync_losses += 1
+                    print(syncprint, "lost sync %s" % ' '.join(["0x%02x" % x for x in lost]))
+                self.start = sync
+
+            available = self.end - self.start
+            if available < 2 or available < self.buffer[self.start + 1] + 4:
+                if self.start == self.end:
+                    self.reset()
+                elif len(self.buffer) - self.start < 259:  # room for the longest frame
+                    self.compact()
+                self.fill()
+                continue
+
+            start = self.start
+            end = start + self.buffer[start + 1] + 4
+            self.start = end
+
+            checksum = 0
+            for b in self.buffer[start:end]:
+                checksum ^= b
+            if checksum:  # the checksum byte makes the xor of a good frame zero
+                self.checksum_errors += 1
+                print(' '.join(["%02x" % x for x in self.buffer[start:end]]))
+                raise AntChecksumException
+            return self.view[start + 2:end - 1]
+
+
+class AntFrameTemplate:
+    """A preallocated frame for one message id and data length, including
+    the padding written after it.  Data bytes are patched in place and the
+    checksum is kept up to date incrementally, so sending it again only
+    costs the bytes that changed."""
+
+    def __init__(self, id, data, pad=3):
+        "data is a list of values (as ints), the channel number first"
+        self.checksum_pos = 3 + len(data)
+        self.length = self.checksum_pos + 1  # without padding
+        self.buffer = bytearray([0xa4, len(data), id] + data + [0] * (1 + pad))
+        checksum = 0
+        for b in self.buffer[:self.checksum_pos]:
+            checksum ^= b
+        self.buffer[self.checksum_pos] = checksum
+
+    def set(self, index, value):
+        "sets data byte index, 0 being the byte after the message id"
+        pos = 3 + index
+        value &= 0xff
+        self.buffer[self.checksum_pos] ^= self.buffer[pos] ^ value
+        self.buffer[pos] = value
+
+    def set_uint16_le(self, index, value):
+        pos = 3 + index
+        buffer = self.buffer
+        lsb = value & 0xff
+        msb = (value >> 8) & 0xff
+        buffer[self.checksum_pos] ^= buffer[pos] ^ lsb ^ buffer[pos + 1] ^ msb
+        buffer[pos] = lsb
+        buffer[pos + 1] = msb
+
+    def data(self):
+        return list(self.buffer[3:self.checksum_pos])
+
+    def message(self):
+        "the frame without padding"
+        return bytes(self.buffer[:self.length])
+
+
+_messages = None
+
+
 def load_ant_messages():
-    import ant_messages
+    """The MessageSet for every message definition, built once per process,
+    and read from the message cache where that's up to date"""
+    global _messages
+    if _messages is None:
+        from . import message_cache
+        _messages = message_cache.cached(build_ant_messages)
+    return _messages
+
+
+def build_ant_messages():
+    from . import ant_messages
     try:
-        import quarq_messages
+        from . import quarq_messages
     except ImportError:
         quarq_messages = None
 
-    import ant_sport_messages
+    from . import ant_sport_messages
 
     messages = ant_sport_messages.messages
     if quarq_messages:
@@ -88,6 +232,7 @@ def load_ant_messages():
         messages.messages_keys.remove(m)
         messages.messages_keys.append(m)
 
+    messages.build_index()
     return messages
 
 
@@ -95,9 +240,9 @@ class Ant:
     def __init__(self, quiet=False, silent=False):
         self.quiet = quiet
         self.silent = silent
-        self.messages = load_ant_messages()
 
         self.t0 = time.time()
+        self.unknown_messages = 0
 
         class NoPortException(Exception): pass
 
@@ -107,16 +252,29 @@ class Ant:
             def write(self, n): raise NoPortException
 
         self.sp = None  # NoPort()
+        self.framer = None
 
-        self.ant_pad = '\0\0\0'
+        self.ant_pad = b'\0\0\0'
 
         self.rssi_log = {}
         self.rssi_logging = False
 
-    def serial_init(self, port=None):
+    def __getattr__(self, name):
+        # the message definitions are only loaded once the first message is decoded
+        if name == 'messages':
+            self.messages = load_ant_messages()
+            return self.messages
+        raise AttributeError(name)
+
+    def serial_init(self, port=None, reset=True):
+        """Without reset, a device already answering at the port's baud rate
+        is left as it is, channels and all"""
         if None == port:
             port = guess_ant_serial_port()
         self.sp = port
+        if not reset and self.inner_probe():
+            self.flush_input()
+            return
         self.sp.setTimeout(120)  # Sometimes the initial message takes a long time to come in.
         try:
             "RESET and TEST together make up the SBW pair for AT3 module"
@@ -135,7 +293,7 @@ class Ant:
             pass
 
         self.baudrate_probe()
-        self.sp.flushInput()
+        self.flush_input()
 
     def network_init(self, port=None):
         self.sp = port
@@ -157,21 +315,37 @@ class Ant:
         baudrates.remove(self.sp.baudrate)
         baudrates = [self.sp.baudrate] + baudrates
         for baudrate in baudrates:
-            if not self.quiet: print "trying", baudrate
+            if not self.quiet: print("trying", baudrate)
             self.sp.setBaudrate(baudrate)
             if self.reset_system_and_probe(timeout):
                 return
         raise Exception("Where's Ant?")
 
     def flush(self):
-        self.sp.flushInput()
+        self.flush_input()
         self.sp.flushOutput()
 
+    def flush_input(self):
+        self.sp.flushInput()
+        if self.framer:
+            self.framer.reset()
+
+    def get_framer(self):
+        if self.framer is None or self.framer.port is not self.sp:
+            self.framer = AntFramer(self.sp)
+        return self.framer
+
+    def data_waiting(self):
+        return self.get_framer().buffered() or self.sp.inWaiting()
+
     def assemble_message(self, id, data):
-        message = [0xa4,  # sync
-                   len(data),
-                   id] + data
-        checksum = reduce(lambda x, y: x ^ y, message)
+        "the whole frame for message id and data, a list of values (as ints), as a bytearray"
+        message = bytearray([0xa4,  # sync
+                             len(data),
+                             id] + data)
+        checksum = 0
+        for b in message:
+            checksum ^= b
         message.append(checksum)
 
         return message
@@ -180,8 +354,7 @@ class Ant:
         "data is a list of values (as ints)"
         message = self.assemble_message(id, data)
 
-        message = ''.join([chr(c) for c in message])
-        self.sp.write(message + self.ant_pad)
+        self.sp.write(bytes(message + self.ant_pad))
         self.sp.flush()
 
         # this sleep is to work around bugs in cp210x driver...
@@ -190,18 +363,43 @@ class Ant:
         if not self.quiet:
             self.print_message(message)
 
+    def send_frame(self, template):
+        "writes an AntFrameTemplate, padding included, in one call"
+        self.sp.write(template.buffer)
+        self.sp.flush()
+
+        # this sleep is to work around bugs in cp210x driver...
+        time.sleep(template.length * 10.0 / self.sp.getBaudrate())
+
+        if not self.quiet:
+            self.print_message(template.message())
+
     def print_message(self, message):
-        print "sending message %s [ %s ]" % (ant_ids[ord(message[2])], ' '.join(["%02x" % ord(c) for c in message]))
+        message = bytearray(message)
+        print("sending message %s [ %s ]" % (ant_ids[message[2]], ' '.join(["%02x" % c for c in message])))
 
     def get_byte(self):
-        while 1:
-            b = self.sp.read(1)
-            if b == '':
-                raise AntNoDataException
-            else:
-                break
+        # through the framer, so that bytes it has already read aren't lost
+        return self.get_framer().read_byte()
+
+    def read_frame(self, source, syncprint=''):
+        "reads a frame one byte at a time from source"
+        x = source()
+        while x != 0xa4:
+            if x:
+                print(syncprint, "lost sync 0x%02x" % x)
+            x = source()
+
+        datalen = source()
+        id = source()
+        data = [source() for c in range(datalen)]
+        checksum = source()
 
-        return ord(b)
+        if self.assemble_message(id, data)[-1] != checksum:
+            print(id, data)
+            raise AntChecksumException
+
+        return memoryview(bytearray([id] + data))
 
     def receive_message(self, source=None, dispose=None, wait=30.0, syncprint=''):
         # wait 0.0 is forever?
@@ -209,42 +407,33 @@ class Ant:
         self.sp.setTimeout(wait)
 
         try:
-
-            if (None == source): source = self.get_byte
-            if (None == dispose): dispose = self.interpret_message
-            x = source()
-            while x != 0xa4:
-                if x:
-                    print syncprint, "lost sync 0x%02x" % x
-                x = source()
-
-            datalen = source()
-            id = source()
-            data = [source() for c in range(datalen)]
-            checksum = source()
-
-            if self.assemble_message(id, data)[-1] != checksum:
-                print id, data
-                raise AntChecksumException
+            if None == source:
+                frame = self.get_framer().next_frame(syncprint)
+            else:
+                frame = self.read_frame(source, syncprint)
 
         finally:
             if not wait:
                 self.sp.setTimeout(timeout)
 
-        m = dispose(id, data)
+        if None == dispose:
+            # a copy, the framer's buffer is reused and decoded messages keep theirs
+            m = self.interpret_frame(frame.tobytes())
+        else:
+            data = list(bytearray(frame))
+            m = dispose(data[0], data[1:])
         if self.rssi_logging:
             self.log_rssi(m)
         return m
 
     def flush_msg_queue(self):
-        while self.sp.inWaiting() > 0:
+        while self.data_waiting() > 0:
             m = self.receive_message()
 
     def get_msg_queue(self):
-        from copy import deepcopy
         msgs = []
-        while self.sp.inWaiting() > 0:
-            msgs.append(deepcopy(self.receive_message()))
+        while self.data_waiting() > 0:
+            msgs.append(self.receive_message())
         msgs.append(self.receive_message())
         return msgs
 
@@ -255,14 +444,14 @@ class Ant:
             self.rssi_logging = False
 
     def log_rssi(self, message):
-        if message.has_key('device_number'):
+        if 'device_number' in message:
             # check if device number is already in dict, if not, create it
-            if not self.rssi_log.has_key(message['device_number']):
+            if message['device_number'] not in self.rssi_log:
                 self.rssi_log[message['device_number']] = []
 
-            if message.has_key('rssi'):
+            if 'rssi' in message:
                 self.rssi_log[message['device_number']].append(message['rssi'])
-            elif message.has_key('power_dbm'):
+            elif 'power_dbm' in message:
                 self.rssi_log[message['device_number']].append(message['power_dbm'])
 
     def wait_for_burst(self, timeout=None, channel=1, first_message=None):
@@ -287,8 +476,8 @@ class Ant:
                 raise AntTransferRxFailedException
 
             if (m['seq'] & 3) != nextseq:
-                print "Error!"
-                print m['seq'], nextseq, m['chan_seq']  # , m['data']
+                print("Error!")
+                print(m['seq'], nextseq, m['chan_seq'])  # , m['data']
                 raise AntBurstSequenceError
 
             nextseq = {0: 1,
@@ -316,7 +505,7 @@ class Ant:
             if name and message.name != name: return False
 
             for k in data.keys():
-                if not message.has_key(k): return False
+                if k not in message: return False
                 if message[k] != data[k]: return False
             return True
 
@@ -333,7 +522,7 @@ class Ant:
                 sys.stdout.flush()
             else:
                 if not self.quiet and not self.silent:
-                    print "unwanted message", m, "out of", (",".join([repr(r) for r in responses]))
+                    print("unwanted message", m, "out of", (",".join([repr(r) for r in responses])))
                 last_unwanted = m.name
 
         raise AntResponseTimeoutException
@@ -353,7 +542,7 @@ class Ant:
         t0 = time.time()
         while None == timeout or time.time() < t0 + timeout:
             m = self.receive_message()
-            if m and m.last_message.startswith('\x4e'): return m
+            if m and m.last_message[:1] == b'\x4e': return m
 
         raise AntResponseTimeoutException
 
@@ -409,7 +598,7 @@ class Ant:
                 count = count + 1
                 self.send_message(ANT_Acknowledged_Data, [chan] + data)
                 if not self.silent:
-                    print "... (%d)" % count,
+                    print("... (%d)" % count, end=' ')
                     sys.stdout.flush()
                 while 1:
                     m = self.wait_for_response([['event_rx_fail', {'channel': chan}],
@@ -420,7 +609,7 @@ class Ant:
                                                timeout=10)
 
                     if not self.silent:
-                        print m
+                        print(m)
 
                     if m.name != 'event_rx_fail': break
 
@@ -429,41 +618,41 @@ class Ant:
                     raise Exception("transfer in progress")
                 elif m.name == 'event_transfer_tx_completed':
                     if not self.silent:
-                        print "+",
+                        print("+", end=' ')
                         sys.stdout.flush()
                     return m
 
                 elif m.name == 'event_transfer_tx_failed':
                     if not self.silent:
-                        print "X",
+                        print("X", end=' ')
                         # self.__init__()
                         sys.stdout.flush()
 
                 elif m.name == 'event_rx_fail':
                     if not self.silent:
-                        print "rx_fail",
+                        print("rx_fail", end=' ')
                         sys.stdout.flush()
                     pass
 
                 elif m.name == 'event_rx_search_timeout' and m['channel'] == chan:
-                    print "Rx Search Timeout",
+                    print("Rx Search Timeout", end=' ')
                     sys.stdout.flush()
                     pass
 
             except AntResponseTimeoutException:
-                print "Response timeout.",
+                print("Response timeout.", end=' ')
                 sys.stdout.flush()
                 pass
             except AntWrongResponseException:
-                print "Wrong response.",
+                print("Wrong response.", end=' ')
                 sys.stdout.flush()
                 pass
             except AntBurstFailedError:
-                print "Burst fail.",
+                print("Burst fail.", end=' ')
                 sys.stdout.flush()
                 pass
             except AntNoDataException:
-                print "No data.",
+                print("No data.", end=' ')
                 sys.stdout.flush()
                 pass
 
@@ -496,7 +685,7 @@ class Ant:
             try:
                 data = indata[:]
                 sequence = 0;
-                if not self.quiet: print "starting ", count
+                if not self.quiet: print("starting ", count)
                 while len(data):
                     if progress_func:
                         progress_func(len(data), len(indata))
@@ -507,7 +696,7 @@ class Ant:
                     if len(data) == 0:
                         sequence |= 4
 
-                    thispack = thispack + [chr(0xff)] * (8 - len(thispack))
+                    thispack = thispack + [0xff] * (8 - len(thispack))
 
                     try:
                         while not self.sp.getCTS():
@@ -523,18 +712,12 @@ class Ant:
                                 2: 3,
                                 3: 1}[sequence & 3]
 
-                    if self.sp.inWaiting():
-                        def get_byte_and_print():
-                            x = self.get_byte()
-
-                            # sys.stdout.flush()
-                            return x
-
-                        m = self.receive_message(source=get_byte_and_print)
+                    if self.data_waiting():
+                        m = self.receive_message()
 
                         if not self.quiet:
-                            print "got message during burst:",
-                            print m
+                            print("got message during burst:", end=' ')
+                            print(m)
                         if interpret_response(m):
                             if progress_func:
                                 progress_func(len(data), len(indata))
@@ -546,7 +729,7 @@ class Ant:
                         if m['channel'] == 0:
                             break
 
-                    if not self.silent: print m
+                    if not self.silent: print(m)
 
                     if interpret_response(m):
                         if progress_func:
@@ -558,7 +741,7 @@ class Ant:
                 self.flush_msg_queue()
                 pass
 
-        print "done"
+        print("done")
 
     def get_ant_rev(self):
         self.send_message(ANT_Request_Message, [0, ANT_Version])
@@ -569,8 +752,7 @@ class Ant:
                                        ['invalid_message', {'message_id': 77}]], 10)
 
         if resp.name.startswith('ant_version'):
-            datakeys = filter(lambda x: x.startswith('data'), resp.keys())
-            datakeys.sort(lambda x, y: cmp(int(x[4:]), int(y[4:])))
+            datakeys = sorted([k for k in resp.keys() if k.startswith('data')], key=lambda k: int(k[4:]))
             string = ''.join([chr(resp[k]) for k in datakeys])
             resp['string'] = string
 
@@ -601,7 +783,44 @@ class Ant:
 
         if m.name == 'response_no_error':
             return m
-        raise AntWrongResponseException, m.name + ' for message type ' + ant_ids[message_id]
+        raise AntWrongResponseException(m.name + ' for message type ' + ant_ids[message_id])
+
+    def configure(self, commands, timeout=5.0):
+        """Sends a sequence of configuration messages, each (message id,
+        data), in one write, then collects their responses as they come in,
+        matching each to its message by channel and message id.  Raises
+        AntWrongResponseException for the first message refused, and
+        AntResponseTimeoutException if any are left unanswered."""
+        message = bytearray()
+        for id, data in commands:
+            frame = self.assemble_message(id, data)
+            if not self.quiet:
+                self.print_message(frame)
+            message += frame + self.ant_pad
+        self.sp.write(bytes(message))
+        self.sp.flush()
+
+        # this sleep is to work around bugs in cp210x driver...
+        time.sleep(len(message) * 10.0 / self.sp.getBaudrate())
+
+        pending = [(data[0], id) for id, data in commands]
+        deadline = time.time() + timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise AntResponseTimeoutException
+            try:
+                m = self.receive_message(wait=remaining)
+            except AntNoDataException:
+                continue
+            if not m or 'message_id' not in m or 'channel' not in m:
+                continue
+            key = (m['channel'], m['message_id'])
+            if key not in pending:
+                continue
+            if m.name != 'response_no_error':
+                raise AntWrongResponseException(m.name + ' for message type ' + ant_ids[m['message_id']])
+            pending.remove(key)
 
     def assign_channel(self, channel, type, network, extended=None):
         if None == extended:
@@ -712,16 +931,22 @@ class Ant:
                 return True
 
     def interpret_message(self, id, msgdata):
+        return self.interpret_frame(bytes(bytearray([id] + msgdata)))
 
-        m = self.messages.new_message(''.join([chr(x) for x in [id] + msgdata]))
+    def interpret_frame(self, message):
+        "message is the message id followed by its data, as bytes, see MessageSet.new_message"
+        m = self.messages.new_message(message)
 
         if m:
             t = time.time()
             m['t'] = t
             m['dt'] = t - self.t0
 
+        if False == m:
+            self.unknown_messages += 1
         if False == m and self.quiet == False:
-            print "unknown message 0x%x [%s]" % (id, ', '.join(["0x%x" % z for z in msgdata]))
+            message = bytearray(message)
+            print("unknown message 0x%x [%s]" % (message[0], ', '.join(["0x%x" % z for z in message[1:]])))
         return m
 
 
@@ -749,6 +974,17 @@ def open_serial(serial_name):
     return serial.Serial(serial_name, baudrate=br, rtscts=1)
 
 
+def find_ant_serial_ports():
+    "names of all the serial devices that look like ANT devices"
+    import glob
+
+    names = [n for n in ['/dev/ttyANT0', '/dev/ttyANT1', '/dev/ttyANT2', '/dev/ttyANTDEV',
+                         '/dev/ttyANTRCT', '/dev/tty.SLAB_USBtoUART',
+                         '/dev/cu.ANTUSBStick.slabvcp'] if os.path.exists(n)]
+    names += sorted(glob.glob('/dev/serial/by-id/*ANT*') + glob.glob('/dev/serial/by-id/*Dynastream*'))
+    return names
+
+
 def guess_ant_serial_port():
     "returns serial.Serial instance"
 
@@ -760,10 +996,10 @@ def guess_ant_serial_port():
                         '/dev/cu.ANTUSBStick.slabvcp']:
         try:
             sp = open_serial(serial_name)
-            print 'Opened serial connection with Ant+ device on %s' % serial_name
+            print('Opened serial connection with Ant+ device on %s' % serial_name)
             return sp
         except Exception as e:
-            print e
+            print(e)
             pass
 
     # import ap2
@@ -772,9 +1008,10 @@ def guess_ant_serial_port():
     # except ValueError:
     #    pass
 
-    raise Exception, "No serial port found"
+    raise Exception("No serial port found")
 
 
+import select
 import socket
 
 
@@ -815,8 +1052,11 @@ class SocketProxy:
         pass
 
     def inWaiting(self):
-        self.flushInput()
-        return 0
+        # peek rather than flush, the framer reads whatever is waiting
+        readable, writable, errored = select.select([self.sock], [], [], 0)
+        if not readable:
+            return 0
+        return len(self.sock.recv(4096, socket.MSG_PEEK))
 
     def getCTS(self):
         return True
@@ -851,7 +1091,7 @@ def try_connecting():
 def quicktest():
     a = Ant()
     a.auto_init()
-    print a.get_capabilities()
+    print(a.get_capabilities())
 
 
 if __name__ == "__main__":
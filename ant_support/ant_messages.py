@@ -109,5 +109,5 @@ capabilities_extended   bool CAPABILITIES_FS_ANTFS_ENABLED=advanced_options_2&(1
 
 """
 
-import message_set
+from . import message_set
 messages=message_set.MessageSet(messagesd,message_calculations)
@@ -16,6 +16,7 @@ power crank_SRM              0x4e,channel,0x20,uint8_diff:event_count,uint16_be:
 heartrate heart_rate         0x4e,channel,None,None,None,None,uint16_le_diff:measurement_time,uint8_diff:beats,uint8:instant_heart_rate Ant heart rate monitor
 speed speed                  0x4e,channel,None,None,None,None,uint16_le_diff:measurement_time,uint16_le_diff:wheel_revs
 cadence cadence              0x4e,channel,None,None,None,None,uint16_le_diff:measurement_time,uint16_le_diff:crank_revs
+fitness_equipment target_power 0x4f,channel,0x31,None,None,None,None,None,uint16_le:target_power FE-C target power page from the head unit
 speed_cadence speed_cadence  0x4e,channel,uint16_le_diff:cadence_measurement_time,uint16_le_diff:crank_revs,uint16_le_diff:speed_measurement_time,uint16_le_diff:wheel_revs
 """
 
@@ -62,7 +63,9 @@ speed_cadence   float   timediff=speed_measurement_time/1024.0
 crank_torque    float   timediff=crank_period/2048.0
 wheel_torque    float   timediff=wheel_period/2048.0
 heart_rate      float   timediff=measurement_time/1024.0
+
+target_power    float   target_watts=target_power/4.0
 """
 
-import message_set
+from . import message_set
 messages=message_set.MessageSet(messages, message_calculations)
@@ -0,0 +1,31 @@
+#!/usr/bin/python
+"""What differs between Python 2 and 3 for the codec.
+
+Messages are byte strings: str on Python 2, bytes on Python 3, where
+bytearray and memoryview work as well.  Indexing one gives a one character
+string on Python 2 but an int on Python 3, so the constants the decoder
+compares message bytes with are kept in whichever form indexing gives,
+byte_item(value), and compared without converting every byte read.
+Python 2 decodes a bytearray or memoryview as a str, to_bytes(message).
+"""
+
+import sys
+
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+    def byte_item(value):
+        "value as indexing a message gives it"
+        return value
+
+    # every kind of message indexes like bytes
+    FOREIGN_BYTES = ()
+    to_bytes = bytes
+else:
+    byte_item = chr
+
+    # a bytearray indexes to ints on Python 2, and str() of a memoryview is its repr
+    FOREIGN_BYTES = (bytearray, memoryview)
+
+    def to_bytes(message):
+        return bytes(bytearray(message))
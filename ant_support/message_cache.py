@@ -0,0 +1,86 @@
+#!/usr/bin/python
+"""Keeps the MessageSet built from the message definitions in a file, so
+that parsing the definitions and compiling their calculations happens
+once, not every time a process starts.
+
+The file is keyed on a hash of the definition sources, message_set.py
+itself, CACHE_VERSION and the Python version, and is rebuilt whenever any
+of those change.  It is kept next to this file, one per Python version so
+that Python 2 and 3 don't keep rebuilding each other's, unless
+ANT_MESSAGE_CACHE names another path, which is used as it is; an empty
+ANT_MESSAGE_CACHE turns caching off.  A cache that can't be read or
+written is rebuilt or skipped, never an error.
+"""
+
+import hashlib
+import os
+import sys
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+CACHE_VERSION = 1
+
+SOURCES = ['message_set.py', 'ant_messages.py', 'ant_sport_messages.py', 'quarq_messages.py']
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '.message_cache-py%s.%s' % sys.version_info[:2])
+
+
+def cache_path():
+    return os.environ.get('ANT_MESSAGE_CACHE', DEFAULT_PATH)
+
+
+def source_key():
+    "hash of everything the built MessageSet depends on"
+    h = hashlib.sha1()
+    h.update(('%s %s\n' % (CACHE_VERSION, sys.version)).encode('utf-8'))
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        path = os.path.join(here, name)
+        if os.path.exists(path):
+            h.update(name.encode('utf-8'))
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest().encode('ascii')
+
+
+def load(path, key):
+    "the MessageSet cached at path under key, or None"
+    try:
+        with open(path, 'rb') as f:
+            if f.readline().rstrip() != key:
+                return None
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def save(path, key, messages):
+    "writes to a temporary file first, so that a reader never sees half a cache"
+    temp = '%s.%s' % (path, os.getpid())
+    try:
+        with open(temp, 'wb') as f:
+            f.write(key + b'\n')
+            pickle.dump(messages, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+    except Exception:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+
+def cached(build):
+    "the cached MessageSet, or else the one build() returns, cached for next time"
+    path = cache_path()
+    if not path:
+        return build()
+    key = source_key()
+    messages = load(path, key)
+    if messages is None:
+        messages = build()
+        save(path, key, messages)
+    return messages
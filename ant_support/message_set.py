@@ -28,20 +28,24 @@ or just:
 
 """
 
+from __future__ import print_function
+
+import marshal
 import struct
 import sys
+from functools import reduce
+
+from .compat import FOREIGN_BYTES, byte_item, to_bytes
 
 
 class AntTypeException(Exception):
     def __init__(self, type):
-        print type, "is unknown"
+        print(type, "is unknown")
 
 
 class AccumValue:
     def __init__(self, parent):
         self.name = parent.name + "_accum"
-        self.value = 0
-        self.prev_value = 0
 
 
 class Value:
@@ -97,24 +101,9 @@ class Value:
 
                 elif 'diff' in type:  # "diff" means the value is a cumulative value
                     self.diff = True
-                    self.value = 0
-                    self.prev_value = 0
                     self.accum_value = AccumValue(self)
                 else:
                     self.diff = False
-                    self.value = 0  # None
-
-    def update(self, value):
-
-        if None != self.match_value: return
-
-        if self.diff:
-            self.accum_value.prev_value = self.prev_value
-            self.accum_value.value = value
-            self.value = value - self.prev_value & (256 ** self.width - 1)
-            self.prev_value = value
-        else:
-            self.value = value
 
     def depends(self):
         return [self.name]
@@ -128,32 +117,31 @@ class CalculatedValue:
         self.name = name
         self.eq = equation
         self.parent = parent
-        self.value = None
         self.typename = typename
+        # compiled once, names are what the equation looks up when evaluated
+        self.code = compile(equation.strip(), '<%s.%s>' % (parent.name, name), 'eval')
+        self.names = [n for n in self.code.co_names if n != 'struct' and n not in _builtin_names]
 
-    def update(self):
-        if sys.version_info[1] < 4:  # python 2.3 and earlier need real dict
-            d = {}
-            for k in self.parent.keys():
-                d[k] = self.parent[k]
-        else:
-            d = self.parent
+    def __getstate__(self):
+        # code objects don't pickle, but marshal
+        state = dict(self.__dict__)
+        state['code'] = marshal.dumps(self.code)
+        return state
 
-        self.value = eval(self.eq, {'struct': struct}, d)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.code = marshal.loads(state['code'])
 
     def depends(self):
-        class Sniff(object):
-            def __init__(self):
-                self.requested = []
+        return reduce(lambda x, y: x + y,
+                      [self.parent.byname[x].depends() for x in self.names if x in self.parent.byname], [])
 
-            def __getitem__(self, request):
-                self.requested.append(request)
-                return 1
 
-        s = Sniff()
-        self.value = eval(self.eq, {'struct': struct}, s)
-
-        return reduce(lambda x, y: x + y, [self.parent.byname[x].depends() for x in s.requested], [])
+try:
+    import __builtin__ as _builtins
+except ImportError:
+    import builtins as _builtins
+_builtin_names = set(dir(_builtins))
 
 
 import time
@@ -165,10 +153,12 @@ class AntMessageType:
         self.values = []
         self.calculations = []
         self.desc = desc
+        self.calculate = None
+        self.calculate_code = None
+        self.calculation_order = []
         self.last_message = None
+        self.last_record = None
         self.time = 0
-        self.extravalues = {}
-        self.touched = []
 
         pos = 0
         for v in value_desc.split(','):
@@ -182,9 +172,7 @@ class AntMessageType:
             pos += value.width
 
         self.byname = {}
-        self.keynames = {}
         for v in self.values:
-            self.keynames = v.name
             self.byname[v.name] = v
             if v.match_value is None and v.name != "None" and v.diff:
                 self.byname[v.name + "_accum"] = v.accum_value
@@ -199,33 +187,46 @@ class AntMessageType:
         self.struct_format = endiantest[0] + ''.join([s.width_format for s in self.values])
         # print self.struct_format
 
+        # (position, byte) for every constant in the message, used by the
+        # MessageSet dispatch index instead of unpacking the whole message.
+        # The byte is as indexing a message gives it, see compat.byte_item
+        self.match_bytes = []
+        for v in self.values:
+            if v.match_value is not None:
+                packed = bytearray(struct.pack(endiantest[0] + v.width_format, v.match_value))
+                for i, c in enumerate(packed):
+                    self.match_bytes.append((v.pos + i, byte_item(c)))
+
+        self._build_layout()
+
+    def _build_layout(self):
+        """Lays out the values tuple of the AntMessage records this type
+        decodes: fields, then accumulators, then the hidden _prev values
+        of the accumulators, then calculations.  index maps each name to
+        its position."""
+        # positions in the unpacked struct, don't care bytes aren't unpacked
+        unpacked = [v for v in self.values if v.name != 'None']
+        fields = [(i, v) for i, v in enumerate(unpacked) if v.match_value is None]
+        self.field_positions = [i for i, v in fields]
+        # (position in the struct, position in values, wrap mask) per accumulator
+        self.accums = [(i, n, 256 ** v.width - 1) for n, (i, v) in enumerate(fields) if v.diff]
+        self.prev_values = [0] * len(self.accums)
+
+        accum_values = [v for i, v in fields if v.diff]
+        names = ([v.name for i, v in fields] +
+                 [v.accum_value.name for v in accum_values] +
+                 [v.name + '_prev' for v in accum_values] +
+                 [c.name for c in self.calculation_order])
+        self.index = dict([(n, i) for i, n in enumerate(names)])
+        # keys() ignores don't care, fixed and _prev values
+        self.keynames = tuple([n for n in names if not n.endswith('_prev')])
+        self.keyset = frozenset(self.keynames)
+        self.last_calculated = (None,) * len(self.calculation_order)
+
     def __len__(self):
         return sum([s.width for s in self.values])
 
-    def __getitem__(self, query):
-        if self.byname.has_key(query):
-            return self.byname[query].value
-        if query.endswith("_prev"):
-            actual_query = query[:-len("_prev")]
-            return self.byname[actual_query + '_accum'].prev_value
-        return self.extravalues[query]
-
-    def __setitem__(self, key, value):
-        if self.byname.has_key(key):
-            raise KeyError
-        self.extravalues[key] = value
-
-    def keys(self):
-        return ([v.name for v in self.values if 'value' in dir(v)] +
-                [v.accum_value.name for v in self.values
-                 if 'accum_value' in dir(v)] +
-                [c.name for c in self.calculations] +
-                self.extravalues.keys())  # ignores don't care and fixed values
-
-    def has_key(self, key):
-        return key in self.keys()
-
-    def test(self, message):  # message is list-formatted Ant message
+    def test(self, message):  # message is a byte string, see compat
 
         # print "trying",self.name
 
@@ -249,28 +250,184 @@ class AntMessageType:
 
         return True
 
-    def calc_update(self):
-        try:
-            [c.update() for c in self.calculations]
-        except ZeroDivisionError:
-            pass
+    def matches(self, message):
+        """Same answer as test() for a message of the right length, comparing
+        only the constant bytes"""
+        for pos, value in self.match_bytes:
+            if message[pos] != value:
+                return False
+        return True
+
+    def calc_update(self, values):
+        "returns the calculated values for the decoded values"
+        if self.calculate is None:
+            return ()
+        return self.calculate(values, self.last_calculated)
 
     def update(self, message):
+        """Decodes message, returns a new AntMessage.  Accumulators are
+        differenced against the previous message of this type.  The message
+        is kept for that, so a bytearray or memoryview mustn't change
+        afterwards."""
         self.isrepeat = (message == self.last_message)
-        if self.isrepeat: return True
-
+        if self.isrepeat:
+            return AntMessage(self, self.last_record.values, message)
+
+        unpacked = struct.unpack(self.struct_format, message)
+
+        values = [unpacked[i] for i in self.field_positions]
+        if self.accums:
+            accum = [unpacked[i] for i, n, mask in self.accums]
+            for (i, n, mask), value, prev_value in zip(self.accums, accum, self.prev_values):
+                values[n] = value - prev_value & mask
+            values += accum
+            values += self.prev_values
+
+        values = tuple(values)
+        if self.calculate is not None:
+            calculated = self.calc_update(values)
+            self.last_calculated = calculated
+            values += calculated
+
+        if self.accums:
+            self.prev_values = accum
         self.last_message = message
         self.time = time.time()
-        values = list(struct.unpack(self.struct_format, message))
-        [s.update(values.pop(0)) for s in self.values if s.name != 'None']
-
-        self.calc_update()
-        return True
+        self.last_record = AntMessage(self, values, message)
+        return self.last_record
 
     def add_calculation(self, name, calculation, typename):
         self.calculations.append(CalculatedValue(name, calculation, self, typename))
         self.byname[name] = self.calculations[-1]
 
+    def compile_calculations(self):
+        """Generates one function evaluating all calculations in dependency
+        order, so that calc_update doesn't evaluate equation strings.
+
+        The function takes the decoded values tuple and the previous results,
+        and returns the values in the order of calculation_order.  As before,
+        a division by zero leaves that and the following calculations at their
+        previous values."""
+        self.calculation_order = self._order_calculations()
+        self._build_layout()
+        calc_names = set([c.name for c in self.calculations])
+
+        inputs = []
+        for c in self.calculation_order:
+            for n in c.names:
+                if n not in calc_names and n not in inputs:
+                    inputs.append(n)
+
+        results = ', '.join([c.name for c in self.calculation_order])
+        lines = ['def calculate(values, previous):',
+                 '    %s, = previous' % results]
+        for n in inputs:
+            if n in self.index:
+                lines.append('    %s = values[%d]' % (n, self.index[n]))
+        lines.append('    try:')
+        for c in self.calculation_order:
+            lines.append('        %s = %s' % (c.name, c.eq.strip()))
+        lines.append('    except ZeroDivisionError:')
+        lines.append('        pass')
+        lines.append('    return (%s,)' % results)
+
+        self.calculate_code = compile('\n'.join(lines) + '\n', '<calculations for %s>' % self.name, 'exec')
+        self._define_calculate()
+
+    def _define_calculate(self):
+        namespace = {'struct': struct}
+        exec(self.calculate_code, namespace)
+        self.calculate = namespace['calculate']
+
+    def __getstate__(self):
+        """for the message cache: the calculate function is defined again
+        from its code, which is marshalled, not pickled"""
+        state = dict(self.__dict__)
+        if self.calculate is not None:
+            state['calculate'] = None
+            state['calculate_code'] = marshal.dumps(self.calculate_code)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.calculate_code is not None:
+            self.calculate_code = marshal.loads(state['calculate_code'])
+            self._define_calculate()
+
+    def _order_calculations(self):
+        "calculations sorted so each comes after the calculations it uses"
+        byname = dict([(c.name, c) for c in self.calculations])
+        ordered = []
+        visiting = []
+
+        def visit(c):
+            if c in ordered:
+                return
+            if c in visiting:
+                raise AntTypeException('circular calculation %s.%s' % (self.name, c.name))
+            visiting.append(c)
+            for n in c.names:
+                if n in byname and byname[n] is not c:
+                    visit(byname[n])
+            visiting.remove(c)
+            ordered.append(c)
+
+        for c in self.calculations:
+            visit(c)
+        return ordered
+
+    def __repr__(self):
+        return '<AntMessageType %s>' % self.name
+
+
+class AntMessage(object):
+    """One decoded message, as returned by MessageSet.new_message.
+
+    Decoded values are read-only and laid out by the message type's index.
+    Values attached after decoding (timestamps, RSSI, ...) are kept in a
+    dict of their own, created on first use."""
+    __slots__ = ('message_type', 'values', 'last_message', 'extravalues')
+
+    def __init__(self, message_type, values, message, extravalues=None):
+        self.message_type = message_type
+        self.values = values
+        self.last_message = message
+        self.extravalues = extravalues
+
+    @property
+    def name(self):
+        return self.message_type.name
+
+    @property
+    def desc(self):
+        return self.message_type.desc
+
+    def __getitem__(self, query):
+        i = self.message_type.index.get(query)
+        if i is not None:
+            return self.values[i]
+        if self.extravalues is None:
+            raise KeyError(query)
+        return self.extravalues[query]
+
+    def __setitem__(self, key, value):
+        if key in self.message_type.index:
+            raise KeyError(key)
+        if self.extravalues is None:
+            self.extravalues = {}
+        self.extravalues[key] = value
+
+    def keys(self):
+        keys = list(self.message_type.keynames)
+        if self.extravalues:
+            keys += self.extravalues.keys()
+        return keys
+
+    def has_key(self, key):
+        return key in self.message_type.keyset or (self.extravalues is not None and key in self.extravalues)
+
+    __contains__ = has_key
+
     def __repr__(self):
         return '\'%s\': { %s }' % (
             self.name, ', '.join(["'%s':%s" % (k, self[k]) for k in self.keys() if not k[0] == "_"]))
@@ -292,8 +449,94 @@ def set_last_power(c):
     # print >>lpf, last_power
 
 
+class ExtendedFormat:
+    """One layout of a message with fields after its payload.  payload()
+    is the message as it would have come without them, the data payload of
+    the first ten bytes if None.  The fields are decoded with a precompiled
+    struct, straight from the message, into the values attached to the
+    decoded payload."""
+
+    def __init__(self, names, format, offset, payload=None, match=(), scaled=()):
+        self.names = names
+        self.unpack_from = struct.Struct(format).unpack_from
+        self.size = struct.calcsize(format)
+        self.offset = offset
+        self.payload = payload
+        self.match = [(pos, byte_item(value)) for pos, value in match]  # (position, byte) that must also match
+        self.scaled = scaled  # names of values in hundredths
+
+    def matches(self, message):
+        for pos, value in self.match:
+            if message[pos] != value:
+                return False
+        return True
+
+
+def _extended_data_formats():
+    """extended data after a broadcast, acknowledged or burst payload: the
+    flag byte, then the channel id, RSSI and rx timestamp, each there if
+    the flag has its bit set"""
+    formats = []
+    for flag in range(0x20, 0x100, 0x20):
+        names = []
+        format = '<'
+        if flag & 0x80:
+            # the RSSI formats always called it device_type
+            names += ['device_number', 'device_type' if flag & 0x40 else 'device_type_id', 'transmission_type']
+            format += 'HBB'
+        if flag & 0x40:
+            names += ['msg_type', 'rssi', 'rssi_thresh']
+            format += 'Bbb'
+        if flag & 0x20:
+            names += ['rx_timestamp']
+            format += 'H'
+        f = ExtendedFormat(names, format, 11)
+        lengths = [11 + f.size]
+        if flag == 0x40:
+            lengths.append(15)  # seen with a byte of padding
+        for id in (0x4e, 0x4f, 0x50):
+            for length in lengths:
+                formats.append((id, length, 10, flag, f))
+    return formats
+
+
+def _antrct_formats():
+    "the ANTRCT RSSI data messages and transfer complete event, with the transmit power"
+    formats = []
+    # the broadcast, acknowledged or burst data id each RSSI id stands for
+    data_ids = dict([(byte_item(id), bytes(bytearray([id - (0xc1 - 0x4e)]))) for id in (0xc1, 0xc2, 0xc3)])
+    rssi = ExtendedFormat(['channel_number', 'device_number', 'device_type_id', 'transmission_type',
+                           'power_raw', 'power_dbm'], '<BHBBHh', 1,
+                          payload=lambda m: data_ids[m[0]] + m[1:2] + m[10:],
+                          scaled=['power_dbm'])
+    for id in (0xc1, 0xc2, 0xc3):
+        formats.append((id, 18, None, None, rssi))
+
+    # matched as the generic event_transfer_tx_completed
+    tx_complete = ExtendedFormat(['power_raw', 'power_dbm'], '<Hh', 4,
+                                 payload=lambda m: bytes(m[:3]) + b'\x05',
+                                 match=[(2, 0x01)], scaled=['power_dbm'])
+    formats.append((0x40, 8, 3, 0x10, tx_complete))
+    return formats
+
+
+def _extended_formats_table():
+    """{(message id, length): (position of the flag byte, {flag byte: ExtendedFormat})},
+    the message id and flag byte as indexing a message gives them"""
+    table = {}
+    for id, length, flag_pos, flag, f in _extended_data_formats() + _antrct_formats():
+        if flag is not None:
+            flag = byte_item(flag)
+        table.setdefault((byte_item(id), length), (flag_pos, {}))[1][flag] = f
+    return table
+
+
+EXTENDED_FORMATS = _extended_formats_table()
+
+
 class MessageSet:
     def __init__(self, messages='', calculations=''):
+        self.index = None
         self._read_message_types(messages)
         self._read_calculations(calculations)
 
@@ -311,6 +554,7 @@ class MessageSet:
             self.messages_keys.append(name)
 
     def _read_calculations(self, text):
+        touched = []
         for m in text.split('\n'):
             if not m.strip() or m.startswith('#'):  # Allow comments, blank lines
                 continue
@@ -322,6 +566,11 @@ class MessageSet:
             eq = calc.rstrip().rstrip(";")
             calcname, val = eq.split('=')
             self[name].add_calculation(calcname, val, typename)
+            if self[name] not in touched:
+                touched.append(self[name])
+
+        for t in touched:
+            t.compile_calculations()
 
     def __add__(self, other):
         ms = MessageSet()
@@ -336,138 +585,130 @@ class MessageSet:
 
         return ms
 
+    def build_index(self):
+        """Precompiles the dispatch index used by _new_message.
+
+        Message types are bucketed on (length, message id), then on the most
+        discriminating constant byte in the bucket (page number, event code).
+        Every bucket keeps the priority order of messages_keys, so this has to
+        be rebuilt whenever messages_keys is reordered."""
+        ordered = []
+        seen = set()
+        for name in self.messages_keys:
+            if name not in seen:
+                seen.add(name)
+                ordered.append(self.messages[name])
+
+        buckets = {}
+        for t in ordered:
+            length = len(t)
+            ids = [value for pos, value in t.match_bytes if pos == 0]
+            if ids:
+                keys = [(length, ids[0])]
+            else:
+                # no constant message id: a candidate for every id of this length
+                keys = [(length, None)] + [k for k in buckets if k[0] == length and k[1] is not None]
+            for key in keys:
+                if key not in buckets:
+                    # a new id inherits the wildcard candidates seen so far
+                    buckets[key] = list(buckets.get((length, None), []))
+                buckets[key].append(t)
+
+        self.index = {}
+        for key, candidates in buckets.items():
+            self.index[key] = self._discriminate(candidates)
+
+    def _discriminate(self, candidates):
+        """Returns (pos, {byte: candidates}, default_candidates) for the
+        constant byte position that best splits the candidates, or
+        (None, {}, candidates) if none does."""
+        consts = [dict(t.match_bytes) for t in candidates]
+        best = None
+        for pos in set([p for c in consts for p in c if p != 0]):
+            values = [c.get(pos) for c in consts]
+            score = (len([v for v in values if v is not None]), len(set(values)))
+            if best is None or score > best[0]:
+                best = (score, pos)
+
+        if best is None:
+            return None, {}, tuple(candidates)
+
+        pos = best[1]
+        sub = {}
+        for value in set([c.get(pos) for c in consts]) - set([None]):
+            sub[value] = tuple([t for t, c in zip(candidates, consts) if c.get(pos, value) == value])
+        default = tuple([t for t, c in zip(candidates, consts) if pos not in c])
+        return pos, sub, default
+
     def keys(self):
         return self.messages_keys
 
     def has_key(self, key):
-        return self.messages.has_key(key)
+        return key in self.messages
 
     def __getitem__(self, query):
         return self.messages[query]
 
     def check_rssi_message(self, message):
-        # RSSI message, transform to regular message
-        m_c = map(ord, message)
-        # print "m_c:",map(lambda x:"%02X"%x,m_c)
-        # ANTRCT RSSI Broadcast Data, Ack Data,Burst Data
-        if len(m_c) == 18 and m_c[0] in [0xc1, 0xc2, 0xc3]:
-            # print 'ANTRCT RSSI Broadcast Data, Ack Data,Burst Data'
-            replacement_message = [m_c[0] - (0xc1 - 0x4e), m_c[1]] + m_c[10:]
-            mess = self._new_message(''.join(map(chr, replacement_message)))
-            mess['channel_number'] = m_c[1]
-            mess['device_number'] = m_c[2] + (m_c[3] << 8)
-            mess['device_type_id'] = m_c[4]
-            mess['transmission_type'] = m_c[5]
-            mess['power_raw'] = m_c[6] + (m_c[7] << 8)
-            mess['power_dbm'] = (m_c[8] + (m_c[9] << 8))
-            if m_c[9] & 0x80:
-                mess['power_dbm'] -= 0x10000
-            mess['power_dbm'] /= 100.0
-            # return mess
-        # Don't know, ANTRCT RSSI Power
-        elif m_c[0] in [0xc1, 0xc2, 0xc3]:
-            # print 'ANTRCT RSSI Power'
-            raise Exception("WTF?")
-        # ANTRCT RSSI Tx Transfer Complete Event
-        elif len(m_c) == 8 and m_c[0] == 0x40 and m_c[2] == 0x1 and m_c[3] == 0x10:
-            # print 'ANTRCT RSSI Tx Transfer Complete Event'
-            replacement_message = m_c[0:4]
-            replacement_message[3] = 0x05  ##This is a little hackey, makes the
-            # message match the generic 'event_transfer_tx_completed' message
-            mess = self._new_message(''.join(map(chr, replacement_message)))
-            mess['power_raw'] = m_c[4] + (m_c[5] << 8)
-            mess['power_dbm'] = (m_c[6] + (m_c[7] << 8))
-            if m_c[7] & 0x80:
-                mess['power_dbm'] -= 0x10000
-            mess['power_dbm'] /= 100.0
-            # return mess
-        # Extended Ant Messages, RSSI, no timestamp, no channel id
-        elif (len(m_c) in [14, 15]) and m_c[10] == 0x40:
-            # print 'Extended Ant Messages, RSSI, no timestamp, no channel id'
-            # this is the new style of rssi messages (extended, rssi only)
-            # print "m_c:",m_c
-            replacement_message = m_c[0:10]  # 0x10 --> 0x05
-            mess = self._new_message(''.join(map(chr, replacement_message)))
-            mess['msg_type'] = m_c[11]
-            if m_c[12] & 0x80:
-                mess['rssi'] = m_c[12] - 0x100
-            else:
-                mess['rssi'] = m_c[12]
-            if m_c[13] & 0x80:
-                mess['rssi_thresh'] = m_c[13] - 0x100
-            else:
-                mess['rssi_thresh'] = m_c[13]
-            # return mess
-        # Extended Ant Messages, RSSI, Channel ID, no timestamp
-        elif (len(m_c) in [18]) and m_c[10] == 0xC0:
-            # print 'Extended Ant Messages, RSSI, Channel ID, no timestamp'
-            # this is the new style of rssi messages (extended, rssi only)
-            # print "m_c:",m_c
-            replacement_message = m_c[0:10]
-            mess = self._new_message(''.join(map(chr, replacement_message)))
-            mess['device_number'] = m_c[12] * 256 + m_c[11]
-            mess['device_type'] = m_c[13]
-            mess['transmission_type'] = m_c[14]
-            mess['msg_type'] = m_c[15]
-            if m_c[16] & 0x80:
-                mess['rssi'] = m_c[16] - 0x100
-            else:
-                mess['rssi'] = m_c[16]
-            if m_c[17] & 0x80:
-                mess['rssi_thresh'] = m_c[17] - 0x100
-            else:
-                mess['rssi_thresh'] = m_c[17]
-            # return mess
-        # Extended Ant Messages, RSSI, Channel ID, Timestamp
-        elif (len(m_c) in [20]) and m_c[10] == 0xE0:
-            # print 'Extended Ant Messages, RSSI, Channel ID, Timestamp'
-            # this is the new style of rssi messages (extended, rssi only)
-            # print "m_c:",m_c
-            replacement_message = m_c[0:10]
-            mess = self._new_message(''.join(map(chr, replacement_message)))
-            mess['device_number'] = m_c[12] * 256 + m_c[11]
-            mess['device_type'] = m_c[13]
-            mess['transmission_type'] = m_c[14]
-            mess['msg_type'] = m_c[15]
-            if m_c[16] & 0x80:
-                mess['rssi'] = m_c[16] - 0x100
-            else:
-                mess['rssi'] = m_c[16]
-            if m_c[17] & 0x80:
-                mess['rssi_thresh'] = m_c[17] - 0x100
-            else:
-                mess['rssi_thresh'] = m_c[17]
-            mess['rx_timestamp'] = m_c[19] * 256 + m_c[18]
-            # return mess
-        # Flag extended
-        elif m_c[0] in [0x4e, 0x4f, 0x50] and len(m_c) > 10 and m_c[10] in [0x80, 0xe0]:
-            "Flagged extended message"
-            replacement_message = m_c[0:10]
-            mess = self._new_message(''.join(map(chr, replacement_message)))
-            mess['device_number'] = m_c[11] + (m_c[12] << 8)
-            mess['device_type_id'] = m_c[13]
-            mess['transmission_type'] = m_c[14]
-            return mess
-        else:
-            mess = self._new_message(message)
-            # return
-
-        # print mess
+        """Decodes a message that may carry extra fields after its payload:
+        extended data, or the ANTRCT RSSI formats, see EXTENDED_FORMATS.
+        Anything else is decoded as it is."""
+        length = len(message)
+        entry = EXTENDED_FORMATS.get((message[0], length)) if length else None
+        if entry is None:
+            return self._new_message(message)
+
+        flag_pos, by_flag = entry
+        f = by_flag.get(message[flag_pos] if flag_pos is not None else None)
+        if f is None or (f.match and not f.matches(message)):
+            return self._new_message(message)
+
+        mess = self._new_message(message[:10] if f.payload is None else f.payload(message))
+        if mess:
+            mess.extravalues = values = dict(zip(f.names, f.unpack_from(message, f.offset)))
+            for name in f.scaled:
+                values[name] /= 100.0
         return mess
 
     def new_message(self, message):
+        """Decodes message id and payload, given as bytes, bytearray or
+        memoryview.  Returns False if no message type matches."""
+        if message.__class__ in FOREIGN_BYTES:
+            message = to_bytes(message)
         return self.check_rssi_message(message)
 
     def _new_message(self, message):
         """Interprets new message data.  Returns False if no match is found"""
+        if self.index is None:
+            return self._scan_message(message)
+        if not message:
+            return False
+
+        length = len(message)
+        entry = self.index.get((length, message[0]))
+        if entry is None:
+            entry = self.index.get((length, None))
+            if entry is None:
+                return False
+
+        pos, sub, candidates = entry
+        if pos is not None:
+            candidates = sub.get(message[pos], candidates)
+        for t in candidates:
+            if t.matches(message):
+                return t.update(message)
+        return False
+
+    def _scan_message(self, message):
+        """Tries every message type in priority order, used when no index has
+        been built"""
         for m in self.messages_keys:
             if self[m].test(message):
-                self[m].update(message)
-                return self[m]
+                return self[m].update(message)
         return False
 
 
 import pprint
 
 if __name__ == '__main__':
-    print "implement me"
+    print("implement me")
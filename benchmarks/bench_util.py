@@ -0,0 +1,54 @@
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+def allocated_bytes(fn, inputs):
+    """Calls fn once per input with tracemalloc tracing, in a pass of its
+    own so the tracing doesn't slow the timed passes.  Returns the mean of
+    the most memory each call held at once, over what was allocated before
+    it, in bytes: memory allocated and freed within the call counts, unlike
+    the change in live blocks.  None on interpreters without
+    tracemalloc.reset_peak (before Python 3.9)."""
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        total = 0
+        for i in inputs:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(i)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return float(total) / len(inputs)
+
+
+def run(fn, inputs, repeat=3):
+    """Calls fn once per input, repeat times over.
+    Returns (calls per second for the best pass, allocated bytes per call,
+    see allocated_bytes)."""
+    best = None
+    for r in range(repeat):
+        t0 = time.time()
+        for i in inputs:
+            fn(i)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return len(inputs) / best, allocated_bytes(fn, inputs)
+
+
+def report(name, rate, allocated=None):
+    if allocated is None:
+        print("%-40s %12.0f /s" % (name, rate))
+    else:
+        print("%-40s %12.0f /s %8.0f bytes/call" % (name, rate, allocated))
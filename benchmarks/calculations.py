@@ -0,0 +1,46 @@
+#!/usr/bin/python
+"""Calculated-value updates per second, comparing the compiled calculations
+against evaluating each equation string in turn.
+
+Run from the repository root:  python -m benchmarks.calculations"""
+
+import struct
+
+from ant_support import ant
+
+from benchmarks import bench_util
+from benchmarks import corpus
+
+COUNT = 20000
+
+
+def calc_strings(message_type, message):
+    "how calc_update used to work: one eval of the equation string per calculation"
+    try:
+        for c in message_type.calculations:
+            eval(c.eq, {'struct': struct}, message)
+    except ZeroDivisionError:
+        pass
+
+
+def calc_compiled(message_type, message):
+    message_type.calc_update(message.values)
+
+
+def main():
+    messages = ant.load_ant_messages()
+
+    for name, page in [('wheel_torque', 0x11), ('crank_torque', 0x12), ('crank_SRM', 0x20)]:
+        message_type = messages[name]
+        decoded = [message_type.update(frame) for frame in corpus.torque_pages(page, COUNT)]
+
+        strings, allocated = bench_util.run(lambda m: calc_strings(message_type, m), decoded)
+        compiled, allocated = bench_util.run(lambda m: calc_compiled(message_type, m), decoded)
+
+        updates = len(message_type.calculations)
+        bench_util.report("%s string eval (values)" % name, strings * updates)
+        bench_util.report("%s compiled (values)" % name, compiled * updates)
+        print("%-40s %12.1fx" % ("%s speedup" % name, compiled / strings))
+
+if __name__ == "__main__":
+    main()
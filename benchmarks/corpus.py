@@ -0,0 +1,138 @@
+"""Generated ANT frames for the benchmarks.
+
+Frames are in the form MessageSet.new_message takes them: message id followed
+by the payload, without sync, length or checksum, as bytes."""
+
+import random
+
+
+def frame(*values):
+    return bytes(bytearray([v & 0xff for v in values]))
+
+
+def power_pages(count, channel=0):
+    "standard power (0x10) pages with a moving event counter and accumulated power"
+    frames = []
+    accum = 0
+    for i in range(count):
+        power = 150 + (i * 7) % 200
+        accum += power
+        frames.append(frame(0x4e, channel, 0x10, i, 0xff, 85, accum, accum >> 8, power, power >> 8))
+    return frames
+
+
+def channel_events(count, channel=0):
+    "event_tx interleaved with the odd response_no_error"
+    frames = []
+    for i in range(count):
+        if i % 16 == 15:
+            frames.append(frame(0x40, channel, 0x4e, 0x00))
+        else:
+            frames.append(frame(0x40, channel, 0x4e, 0x03))
+    return frames
+
+
+def mixed(count, seed=0):
+    "what a transmitting channel typically sees: mostly events, some data pages"
+    rnd = random.Random(seed)
+    pool = channel_events(count) + power_pages(count)
+    return [rnd.choice(pool) for i in range(count)]
+
+
+def torque_pages(page, count, channel=0):
+    "wheel (0x11), crank (0x12) or SRM crank (0x20) torque pages with accumulating counters"
+    frames = []
+    period = 0
+    torque = 0
+    for i in range(count):
+        period += 1800 + (i * 13) % 400
+        torque += 600 + (i * 29) % 300
+        if page == 0x20:
+            frames.append(frame(0x4e, channel, page, i, 0, 25, period >> 8, period, torque >> 8, torque))
+        else:
+            frames.append(frame(0x4e, channel, page, i, i, 85, period, period >> 8, torque, torque >> 8))
+    return frames
+
+
+def common_pages(count, channel=0):
+    "manufacturer (0x50), product (0x51) and battery (0x52) pages in turn"
+    frames = []
+    for i in range(count):
+        page = 0x50 + i % 3
+        if page == 0x50:
+            frames.append(frame(0x4e, channel, page, 0xff, 0xff, 0x0d, 7, 0, 1 + i % 4, 0))
+        elif page == 0x51:
+            frames.append(frame(0x4e, channel, page, 0xff, 0xff, 12, i, i >> 8, 0x34, 0x12))
+        else:
+            frames.append(frame(0x4e, channel, page, 0xff, 0xff, i, i >> 8, 0, 0x80 + i % 256, 0x32))
+    return frames
+
+
+def heart_rate_pages(count, channel=0):
+    "heart rate pages, toggling the page change bit every four messages"
+    frames = []
+    time = 0
+    beats = 0
+    for i in range(count):
+        time += 800 + (i * 11) % 200
+        beats += 1
+        frames.append(frame(0x4e, channel, (i // 4 % 2) << 7 | 4, 0xff, 0xff, 0xff, time, time >> 8, beats,
+                            120 + i % 60))
+    return frames
+
+
+def speed_cadence_pages(count, channel=0):
+    """combined speed and cadence sensor pages.  These have no page number,
+    so with no channel to tell them apart they decode as heart rate."""
+    frames = []
+    crankTime = crankRevs = wheelTime = wheelRevs = 0
+    for i in range(count):
+        crankTime += 700 + i % 50
+        crankRevs += 1
+        wheelTime += 300 + i % 30
+        wheelRevs += 2
+        frames.append(frame(0x4e, channel, crankTime, crankTime >> 8, crankRevs, crankRevs >> 8,
+                            wheelTime, wheelTime >> 8, wheelRevs, wheelRevs >> 8))
+    return frames
+
+
+# extended data flag byte, for each combination of trailing fields
+EXTENDED_FLAGS = {'channel_id': 0x80,
+                  'rssi': 0x40,
+                  'timestamp': 0x20,
+                  'channel_id_rssi': 0xc0,
+                  'channel_id_timestamp': 0xa0,
+                  'rssi_timestamp': 0x60,
+                  'channel_id_rssi_timestamp': 0xe0}
+
+
+def extended(frames, flag, device_number=12340, device_type=11, transmission_type=5, rssi=-60, threshold=-96):
+    """broadcast frames as they come with extended data enabled: the flag
+    byte then channel id, RSSI and rx timestamp, whichever the flag says"""
+    result = []
+    for i, f in enumerate(frames):
+        trailer = [flag]
+        if flag & 0x80:
+            trailer += [device_number, device_number >> 8, device_type, transmission_type]
+        if flag & 0x40:
+            trailer += [0x20, rssi, threshold]
+        if flag & 0x20:
+            trailer += [i * 251, (i * 251) >> 8]
+        result.append(f + frame(*trailer))
+    return result
+
+
+def antrct_rssi(frames, device_number=12340, device_type=11, transmission_type=5, power_dbm=-61.5):
+    "broadcast frames in the ANTRCT RSSI format, with the channel id and power ahead of the data"
+    dbm = int(power_dbm * 100)
+    result = []
+    for i, f in enumerate(frames):
+        result.append(frame(0xc1, bytearray(f)[1], device_number, device_number >> 8, device_type, transmission_type,
+                            200 + i % 50, 0, dbm, dbm >> 8) + f[2:])
+    return result
+
+
+def antrct_tx_complete(count, channel=0, power_dbm=-61.5):
+    "ANTRCT transfer complete events with the transmit power"
+    dbm = int(power_dbm * 100)
+    return [frame(0x40, channel, 0x01, 0x10, 200 + i % 50, 0, dbm, dbm >> 8) for i in range(count)]
@@ -0,0 +1,28 @@
+#!/usr/bin/python
+"""Compares MessageSet's dispatch index against the linear test() scan.
+
+Run from the repository root:  python -m benchmarks.decode_dispatch"""
+
+from ant_support import ant
+
+from benchmarks import bench_util
+from benchmarks import corpus
+
+COUNT = 20000
+
+
+def main():
+    messages = ant.load_ant_messages()
+
+    for name, frames in [('event_tx', corpus.channel_events(COUNT)),
+                         ('standard_power', corpus.power_pages(COUNT)),
+                         ('mixed', corpus.mixed(COUNT))]:
+        scan, allocated = bench_util.run(messages._scan_message, frames)
+        bench_util.report("%s linear scan" % name, scan, allocated)
+        indexed, allocated = bench_util.run(messages._new_message, frames)
+        bench_util.report("%s indexed" % name, indexed, allocated)
+        print("%-40s %12.1fx" % ("%s speedup" % name, indexed / scan))
+
+
+if __name__ == "__main__":
+    main()
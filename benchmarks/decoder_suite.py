@@ -0,0 +1,149 @@
+#!/usr/bin/python
+"""Decoder throughput across the kinds of frame the ANT stick hands us.
+
+For each group of generated frames: new_message per second and the bytes
+allocated per message (see bench_util.allocated_bytes), whole corpus.  Then
+per message type, the cost of each step: new_message as a whole, the test()
+match, update() decoding and the calculated values.  Results can be saved as
+JSON and compared against an earlier run, so regressions in either show up.
+
+Run from the repository root:
+  python -m benchmarks.decoder_suite [results.json [baseline.json]]"""
+
+import json
+import platform
+import sys
+import time
+
+from ant_support import ant
+
+from benchmarks import bench_util
+from benchmarks import corpus
+
+COUNT = 5000
+
+
+def groups():
+    power = corpus.power_pages(COUNT)
+    result = [('standard_power', power),
+              ('wheel_torque', corpus.torque_pages(0x11, COUNT)),
+              ('crank_torque', corpus.torque_pages(0x12, COUNT)),
+              ('crank_SRM', corpus.torque_pages(0x20, COUNT)),
+              ('common_pages', corpus.common_pages(COUNT)),
+              ('heart_rate', corpus.heart_rate_pages(COUNT)),
+              ('speed_cadence', corpus.speed_cadence_pages(COUNT)),
+              ('channel_events', corpus.channel_events(COUNT)),
+              ('antrct_rssi', corpus.antrct_rssi(power)),
+              ('antrct_tx_complete', corpus.antrct_tx_complete(COUNT))]
+    for name, flag in sorted(corpus.EXTENDED_FLAGS.items()):
+        result.append(('ext_' + name, corpus.extended(power, flag)))
+    return result
+
+
+def measure(fn, frames):
+    rate, allocated = bench_util.run(fn, frames)
+    return {'rate': rate, 'allocated': allocated}
+
+
+def decodable(messages, frames):
+    """(frames that decode without raising, how many of those are understood).
+    A few generated frames trip over errors in the message definitions, such
+    as the manufacturer page's radio lookup, and are left out of timings."""
+    result = []
+    decoded = 0
+    for f in frames:
+        try:
+            if messages.new_message(f):
+                decoded += 1
+        except Exception:
+            continue
+        result.append(f)
+    return result, decoded
+
+
+def by_type(messages, frames):
+    "the frames with a plain (not extended) encoding, grouped by the type they decode as"
+    result = {}
+    for f in frames:
+        m = messages._new_message(f)
+        if m:
+            result.setdefault(m.name, []).append(f)
+    return result
+
+
+def type_costs(messages, message_type, frames):
+    decoded = [message_type.update(f) for f in frames]
+    costs = {'new_message': measure(messages.new_message, frames),
+             'test': measure(message_type.test, frames),
+             'update': measure(message_type.update, frames)}
+    if message_type.calculate is not None:
+        costs['calculations'] = measure(lambda m: message_type.calc_update(m.values), decoded)
+    return costs
+
+
+def run():
+    messages = ant.load_ant_messages()
+    results = {'python': platform.python_version(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'groups': {},
+               'types': {}}
+
+    plain = []
+    for name, frames in groups():
+        frames, decoded = decodable(messages, frames)
+        result = measure(messages.new_message, frames)
+        result['decoded'] = float(decoded) / COUNT
+        results['groups'][name] = result
+        bench_util.report("%s new_message" % name, result['rate'], result['allocated'])
+        if result['decoded'] < 1:
+            print("%-40s %11.1f%%" % ("%s decoded" % name, result['decoded'] * 100))
+        if not name.startswith('ext_') and not name.startswith('antrct'):
+            plain += frames
+
+    print("")
+    for name, frames in sorted(by_type(messages, plain).items()):
+        costs = type_costs(messages, messages[name], frames)
+        results['types'][name] = costs
+        for step in ['new_message', 'test', 'update', 'calculations']:
+            if step in costs:
+                bench_util.report("%s %s" % (name, step), costs[step]['rate'], costs[step]['allocated'])
+
+    return results
+
+
+def compare_one(name, result, base):
+    "the rate as a multiple of the baseline's, and the change in bytes allocated where both have them"
+    line = "%-40s %12.2fx" % (name, result['rate'] / base['rate'])
+    if result.get('allocated') is not None and base.get('allocated') is not None:
+        change = result['allocated'] - base['allocated']
+        line += " %+8.0f bytes/call%s" % (change, " MORE" if change > 0.5 else "")
+    print(line)
+
+
+def compare(results, baseline):
+    "prints how the message rates and allocations moved since the baseline"
+    print("")
+    print("Against the baseline from %s, Python %s:" % (baseline['time'], baseline['python']))
+    for name, result in sorted(results['groups'].items()):
+        if name in baseline['groups']:
+            compare_one(name, result, baseline['groups'][name])
+    for name, costs in sorted(results['types'].items()):
+        for step, result in sorted(costs.items()):
+            if step in baseline['types'].get(name, {}):
+                compare_one("%s %s" % (name, step), result, baseline['types'][name][step])
+
+
+def main():
+    results = run()
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            compare(results, json.load(f))
+    if results['groups']['standard_power']['allocated'] is None:
+        print("(allocations per message are only reported on Python 3.9 and later)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+"""The whole adapter, an emulated bike in and an emulated ANT stick out:
+latency of each new sample through each stage, from the bike's reply being
+read to the event_tx for the slot it went out in, and of target power
+changes from the head unit to the bike.  Needs pseudo-terminals,
+so Linux or Mac.
+
+Run from the repository root:  python -m benchmarks.end_to_end [seconds]"""
+
+import sys
+import threading
+
+from serial import Serial
+
+from components.ant_writer import PowerWriter
+from components.kettler_serial import Kettler
+from components.timing import PollScheduler, monotonic
+from emulators.ant_stick import AntStickEmulator
+from emulators.kettler import KettlerEmulator, Profile
+
+TARGET_INTERVAL_SECS = 2.0  # how often the emulated head unit changes the target power
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+
+    stick = AntStickEmulator()
+    stick.start()
+    bike = KettlerEmulator(Profile.ramp(seconds, 100, 400), latencySecs=0.015, jitterSecs=0.01)
+    bike.start()
+
+    antWriter = PowerWriter(transmitIntervalMillis=250,
+                            networkKey=[0] * 8,
+                            syncToEventTx=True,
+                            port=Serial(stick.portName, baudrate=57600, rtscts=1))
+    kettler = Kettler(Serial(bike.portName, baudrate=57600, timeout=1))
+
+    antThread = threading.Thread(target=antWriter.start)
+    antThread.setDaemon(True)
+    antThread.start()
+
+    started = monotonic()
+    targetsSent = 0
+    for model in kettler.readModels(PollScheduler(antWriter.txStats), antWriter.targetPower):
+        if model is not None:
+            antWriter.updateModel(model)
+        now = monotonic() - started
+        if now > seconds:
+            break
+        if now > TARGET_INTERVAL_SECS * (targetsSent + 1):
+            targetsSent += 1
+            quarterWatts = (150 + 50 * (targetsSent % 4)) * 4
+            stick.receiveAcknowledged(0, [0x31, 0xff, 0xff, 0xff, 0xff, 0xff, quarterWatts & 0xff, quarterWatts >> 8])
+    antWriter.stop()
+    antThread.join(5)
+    stick.stop()
+    bike.stop()
+
+    print("")
+    print("Kettler rpc: %s" % kettler.rpcEngine)
+    print("Sample latency by stage:\n%s" % antWriter.latencies)
+    print("Target power from head unit to bike: %s" % kettler.targetLatency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+"""Power page frames encoded per second, and the memory each allocates (see
+bench_util.allocated_bytes), building the frame from a list as send_message
+does against patching an AntFrameTemplate.
+
+Run from the repository root:  python -m benchmarks.frame_encoder"""
+
+from ant_support import ant
+
+from benchmarks import bench_util
+
+COUNT = 50000
+
+
+class PowerPageEncoder:
+    def __init__(self):
+        self.ant = ant.Ant(quiet=True)
+        self.power_accum = 0
+        self.event_counter = 0
+        self.template = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [0, 0x10, 0, 0x80 | 50, 0, 0, 0, 0, 0])
+
+    def from_list(self, sample):
+        "what broadcastPower and send_message used to do, without the write"
+        power, cadence = sample
+        self.power_accum += power
+        data = [0x10,
+                (self.event_counter + 128) & 0xff,
+                0x80 | 50,
+                int(cadence),
+                int(self.power_accum) & 0xff,
+                (int(self.power_accum) >> 8) & 0xff,
+                int(power) & 0xff,
+                (int(power) >> 8) & 0xff]
+        self.event_counter = (self.event_counter + 1) % 0xff
+        message = self.ant.assemble_message(ant.ANT_Broadcast_Data, [0] + data)
+        return bytes(message + self.ant.ant_pad)
+
+    def from_template(self, sample):
+        power, cadence = sample
+        self.power_accum += power
+        page = self.template
+        page.set(2, self.event_counter + 128)
+        page.set(4, int(cadence))
+        page.set_uint16_le(5, int(self.power_accum))
+        page.set_uint16_le(7, int(power))
+        self.event_counter = (self.event_counter + 1) % 0xff
+        return page.buffer
+
+
+def main():
+    samples = [(150 + i % 200, 60 + i % 40) for i in range(COUNT)]
+
+    # both must produce the same bytes
+    check = PowerPageEncoder(), PowerPageEncoder()
+    for sample in samples[:1000]:
+        assert bytes(check[1].from_template(sample)) == check[0].from_list(sample)
+
+    before, before_allocated = bench_util.run(PowerPageEncoder().from_list, samples)
+    after, after_allocated = bench_util.run(PowerPageEncoder().from_template, samples)
+    bench_util.report("power page from list", before, before_allocated)
+    bench_util.report("power page from template", after, after_allocated)
+    print("%-40s %12.1fx" % ("speedup", after / before))
+    if before_allocated is None:
+        print("(allocations per frame are only reported on Python 3.9 and later)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+"""The Kettler input loop against an emulated bike that is slow, noisy and
+drops replies: samples per second, reply latency, and how the bad lines,
+timeouts and repeated status lines were counted.  Needs a pseudo-terminal,
+so Linux or Mac.
+
+Run from the repository root:  python -m benchmarks.kettler_input [seconds]"""
+
+import sys
+
+from serial import Serial
+
+from components.kettler_serial import Kettler
+from components.timing import monotonic
+from emulators.kettler import KettlerEmulator, Profile
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+
+    profile = Profile.ramp(5, 100, 250) + Profile.intervals(3, 2, 400, 3, 150) + Profile.sprint(2, 800)
+    bike = KettlerEmulator(profile, latencySecs=0.015, jitterSecs=0.02, garbageRate=0.02, dropoutRate=0.02,
+                           silences=[(seconds / 2, 1.0)])
+    bike.start()
+
+    kettler = Kettler(Serial(bike.portName, baudrate=57600, timeout=1))
+    end = monotonic() + seconds
+    samples = 0
+    for model in kettler.readModels():
+        if model is not None:
+            samples += 1
+        if monotonic() > end:
+            break
+    bike.stop()
+    bike.join()
+
+    print("%-40s %12.1f /s" % ("distinct status samples", samples / seconds))
+    print("%-40s %s" % ("rpc", kettler.rpcEngine))
+    print("%-40s %s" % ("bad lines", kettler.badLines))
+    print("%-40s %s" % ("repeated status lines skipped", kettler.duplicates))
+    print("%-40s requests[%s] garbage[%s] dropped[%s]" % (
+        "emulated bike", bike.requests, bike.garbageSent, bike.dropped))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+"""PowerWriter against an emulated ANT stick: time to initialise, time to
+reconnect to a stick whose channel is still open, as after a USB hiccup,
+transmit jitter as the writer sees it, and how many channel periods
+carried a fresh page.  Needs a pseudo-terminal, so Linux or Mac.
+
+Run from the repository root:  python -m benchmarks.power_writer [seconds]"""
+
+import sys
+import threading
+import time
+
+from serial import Serial
+
+from components.ant import PowerModel
+from components.ant_writer import PowerWriter
+from components.timing import monotonic
+from emulators.ant_stick import AntStickEmulator
+
+SAMPLE_INTERVAL_SECS = 0.04  # about as often as the bike is polled
+
+
+def feedSamples(antWriter, seconds):
+    end = monotonic() + seconds
+    i = 0
+    while monotonic() < end:
+        antWriter.updateModel(PowerModel(150 + i % 100, 80 + i % 20))
+        i += 1
+        time.sleep(SAMPLE_INTERVAL_SECS)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+
+    stick = AntStickEmulator()
+    stick.start()
+
+    t0 = monotonic()
+    PowerWriter(transmitIntervalMillis=250,
+                networkKey=[0] * 8,
+                syncToEventTx=True,
+                port=Serial(stick.portName, baudrate=57600, rtscts=1))
+    initSecs = monotonic() - t0
+
+    # the first writer is abandoned without closing its channel
+    t0 = monotonic()
+    antWriter = PowerWriter(transmitIntervalMillis=250,
+                            networkKey=[0] * 8,
+                            syncToEventTx=True,
+                            port=Serial(stick.portName, baudrate=57600, rtscts=1))
+    reconnectSecs = monotonic() - t0
+
+    antThread = threading.Thread(target=antWriter.start)
+    antThread.setDaemon(True)
+    antThread.start()
+    feedSamples(antWriter, seconds)
+    antWriter.stop()
+    antThread.join(5)
+    stick.stop()
+    stick.join()
+
+    transmitted = stick.transmitted(0)
+    fresh = len([t for t in transmitted if t.fresh])
+    print("%-40s %12.3f s" % ("initialisation", initSecs))
+    print("%-40s %12.3f s" % ("reconnect", reconnectSecs))
+    print("%-40s %12.1f /s" % ("pages transmitted", len(transmitted) / seconds))
+    print("%-40s %12.1f %%" % ("periods with a fresh page", 100.0 * fresh / max(1, len(transmitted))))
+    print("%-40s %s" % ("event_tx as seen by the writer", antWriter.txStats))
+    print("%-40s %s" % ("event_tx to next page loaded", stick.reloadDelay))
+
+
+if __name__ == "__main__":
+    main()
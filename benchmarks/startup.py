@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""What a new process pays before it can decode its first ANT message:
+importing ant_support.ant, constructing Ant(), and loading the message
+definitions on first use.  Each run is a fresh interpreter, with the
+message cache missing (cold), up to date (warm) and turned off.
+
+Run from the repository root:  python -m benchmarks.startup [runs]"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RUN = """
+import json, time
+t0 = time.time()
+from ant_support import ant
+t1 = time.time()
+a = ant.Ant()
+t2 = time.time()
+a.messages
+t3 = time.time()
+print(json.dumps({'import': t1 - t0, 'Ant()': t2 - t1, 'first load': t3 - t2}))
+"""
+
+STEPS = ['import', 'Ant()', 'first load']
+
+
+def run_once(cachePath):
+    env = dict(os.environ)
+    env['ANT_MESSAGE_CACHE'] = cachePath
+    out = subprocess.check_output([sys.executable, '-c', RUN], env=env)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def report(name, results):
+    for step in STEPS:
+        print("%-40s %12.1f ms" % ("%s %s" % (name, step), median([r[step] for r in results]) * 1000))
+    print("%-40s %12.1f ms" % ("%s total" % name, median([sum(r.values()) for r in results]) * 1000))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+    cachePath = os.path.join(tempfile.mkdtemp(), 'message_cache')
+
+    cold = []
+    for i in range(runs):
+        if os.path.exists(cachePath):
+            os.remove(cachePath)
+        cold.append(run_once(cachePath))
+    warm = [run_once(cachePath) for i in range(runs)]
+    off = [run_once('') for i in range(runs)]
+
+    os.remove(cachePath)
+    os.rmdir(os.path.dirname(cachePath))
+
+    report("cold cache", cold)
+    report("warm cache", warm)
+    report("no cache", off)
+
+
+if __name__ == "__main__":
+    main()
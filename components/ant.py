@@ -1,7 +1,64 @@
-class PowerModel:
-    def __init__(self, power=0, cadence=0):
+from components.timing import monotonic
+
+
+class PowerModel(object):
+    """One sample from the bike.  Only power and cadence are needed to
+    broadcast power, the other fields of the Kettler status record are None
+    when the sample came from elsewhere."""
+    __slots__ = ('power', 'cadence', 'timestamp', 'stored',
+                 'heartRate', 'speed', 'distance', 'destPower', 'energy', 'elapsedTime')
+
+    def __init__(self, power=0, cadence=0, timestamp=None,
+                 heartRate=None, speed=None, distance=None, destPower=None, energy=None, elapsedTime=None):
         self.power = power
         self.cadence = cadence
+        # when the sample was taken, on the monotonic clock
+        self.timestamp = monotonic() if timestamp is None else timestamp
+        # when it was handed to the ANT thread
+        self.stored = None
+        self.heartRate = heartRate
+        self.speed = speed  # 0.1km/h
+        self.distance = distance  # as the bike reports it
+        self.destPower = destPower  # the power the bike is set to
+        self.energy = energy
+        self.elapsedTime = elapsedTime  # seconds
 
     def __str__(self):
         return "power[" + str(self.power) + "] cadence[" + str(self.cadence) + "]"
+
+
+class TargetPower:
+    """Hands the latest target power from the head unit, received on the ANT
+    thread, to the thread talking to the bike.  Like ModelExchange, it is a
+    single reference store of (sequence number, watts, time received), so
+    neither side ever waits for the other."""
+
+    def __init__(self):
+        self.latest = (0, None, None)
+
+    def publish(self, watts, received):
+        self.latest = (self.latest[0] + 1, watts, received)
+
+    def read(self):
+        "returns (sequence number, watts, time received)"
+        return self.latest
+
+
+class ModelExchange:
+    """Hands the latest sample from the input thread to the ANT thread.
+
+    Samples are never modified once published, and publishing is a single
+    reference store of (sequence number, sample), which is atomic in
+    CPython, so the reader always gets a consistent sample without taking a
+    lock.  There must only be one publishing thread.  The sequence number
+    tells the reader whether anything new has arrived since it last read."""
+
+    def __init__(self, model=None):
+        self.latest = (0, model if model is not None else PowerModel())
+
+    def publish(self, model):
+        self.latest = (self.latest[0] + 1, model)
+
+    def read(self):
+        "returns (sequence number, sample)"
+        return self.latest
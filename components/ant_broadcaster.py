@@ -2,11 +2,15 @@
 
 from ant_support import ant
 
+from components.ant import TargetPower
+from components.timing import LatencyHistogram, TransmitStats, monotonic
+
 ANT_NETWORK = 1
 
 ANT_DEVICE_TYPE_POWER = 11
 ANT_DEVICE_TYPE_FITNESS_EQUIPMENT = 0x11
 ANT_FITNESS_EQUIPMENT_TYPE_STATIONARY_BIKE = 21
+ANT_FITNESS_EQUIPMENT_TYPE_TRAINER = 25  # trainer or stationary bike, the type head units look for
 
 ANT_POWER_PROFILE_POwER_PAGE = 0x10
 ANT_FITNESS_EQUIPMENT_PROFILE_GENERAL_DATA_PAGE = 0x10
@@ -14,44 +18,114 @@ ANT_FITNESS_EQUIPMENT_PROFILE_GENERAL_SETTINGS_PAGE = 0x17
 ANT_FITNESS_EQUIPMENT_PROFILE_STATIONARY_BIKE_DATA_PAGE = 0x15
 ANT_FITNESS_EQUIPMENT_PROFILE_TRAINER_DATA_PAGE = 0x19
 ANT_FITNESS_EQUIPMENT_PROFILE_TARGET_POWER_PAGE = 0x31  # head unit -> device
+ANT_COMMON_MANUFACTURER_PAGE = 0x50
+ANT_COMMON_PRODUCT_PAGE = 0x51
 
+# general data page capabilities, and the state in its top nibble
+FE_HEART_RATE_SOURCE_HAND_CONTACT = 3
+FE_CAPABILITY_DISTANCE = 1 << 2
+FE_CAPABILITY_VIRTUAL_SPEED = 1 << 3
+FE_STATE_IN_USE = 3
 
-class AntBroadcaster(ant.Ant):
-    def __init__(self, network_key, debug, device_type):
-        ant.Ant.__init__(self, quiet=not debug, silent=False)
+MANUFACTURER_ID = 255  # the development ID
+MODEL_NUMBER = 1
+HARDWARE_REVISION = 1
+SOFTWARE_REVISION = 1
 
-        self.auto_init()
+ANT_CHANNEL_PERIOD = 8182  # in units of 1/32768s, about 4Hz
+ANT_FITNESS_EQUIPMENT_CHANNEL_PERIOD = 8192  # exactly 4Hz
 
-        try:
-            self.close_channel(0)
-        except ant.AntWrongResponseException:
-            pass
+ANT_DEVICE_TYPE_HEART_RATE = 0x78
+ANT_DEVICE_TYPE_SPEED_CADENCE = 0x79
+ANT_HEART_RATE_CHANNEL_PERIOD = 8070
+ANT_SPEED_CADENCE_CHANNEL_PERIOD = 8086
 
-        self.assign_channel(channel=0,
-                            type=ANT_POWER_PROFILE_POwER_PAGE,
-                            network=ANT_NETWORK)
-        self.set_network_key(network=ANT_NETWORK, key=network_key)
+# device numbers are this plus the device type, so each profile's differs
+DEVICE_NUMBER_BASE = 12329
 
-        self.deviceId = 12329 + device_type
-        print("Initialised broadcaster for deviceId[%s] of type[%s]" % (self.deviceId, device_type))
+WHEEL_CIRCUMFERENCE_METRES = 2.096  # 700x23c, what head units assume by default
 
-        self.set_channel_id(channel=0,
-                            device=self.deviceId,
-                            device_type_id=device_type,
-                            man_id=5)
-        self.set_channel_freq(0, 57)
-        self.set_channel_period(0, 8182)
-        self.set_channel_search_timeout(0, 40)
-        self.open_channel(0)
+
+class AntBroadcaster(ant.Ant):
+    def __init__(self, network_key, debug, device_type, port=None, period=ANT_CHANNEL_PERIOD,
+                 deviceNumberBase=DEVICE_NUMBER_BASE):
+        ant.Ant.__init__(self, quiet=not debug, silent=False)
+        self.deviceNumberBase = deviceNumberBase
+
+        if port is None:
+            self.auto_init()
+        else:
+            # a device we had set up before a USB hiccup keeps its channels, see open_broadcast_channel
+            self.serial_init(port, reset=False)
+
+        self.openChannels = []
+        self.channelStats = {}
+        # how long each wait_tx waited for the device
+        self.txWait = LatencyHistogram()
+        # set by the head unit, for the bike to follow
+        self.targetPower = TargetPower()
+
+        self.deviceId = self.open_broadcast_channel(0, device_type, period, network_key)
+        self.txStats = self.channelStats[0]
+
+    def open_broadcast_channel(self, channel, device_type, period, network_key=None):
+        """Opens a master channel broadcasting as device_type, returning its
+        device number, setting the network key first if given.  A channel
+        that is already open with this type, network and channel id is taken
+        over as it is, as after a reconnect.  Otherwise the configuration is
+        sent in one batch, see Ant.configure."""
+        deviceId = self.deviceNumberBase + device_type
+        status = self.get_channel_status(channel)
+        state = status['state']
+
+        if state in ('searching', 'tracking') and self.is_set_up(channel, status, device_type, deviceId):
+            print("Reusing open channel[%s] for deviceId[%s] of type[%s]" % (channel, deviceId, device_type))
+        else:
+            if state in ('searching', 'tracking'):
+                self.close_channel(channel)
+            commands = []
+            if network_key is not None:
+                commands.append((ant.ANT_Set_Network, [ANT_NETWORK] + network_key))
+            if state != 'unassigned':
+                commands.append((ant.ANT_Unassign_Channel, [channel]))
+            commands += [(ant.ANT_Assign_Channel, [channel, ANT_POWER_PROFILE_POwER_PAGE, ANT_NETWORK]),
+                         (ant.ANT_Set_Channel_ID, [channel, deviceId & 0xff, deviceId >> 8, device_type, 5]),
+                         (ant.ANT_Set_Channel_Freq, [channel, 57]),
+                         (ant.ANT_Set_Channel_Period, [channel, period & 0xff, period >> 8]),
+                         (ant.ANT_Set_Channel_Search_Timeout, [channel, 40]),
+                         (ant.ANT_Open_Channel, [channel])]
+            self.configure(commands)
+            print("Initialised broadcaster for deviceId[%s] of type[%s] on channel[%s]" % (deviceId, device_type, channel))
+
+        self.openChannels.append(channel)
+        self.channelStats[channel] = TransmitStats(period / 32768.0)
+        return deviceId
+
+    def is_set_up(self, channel, status, device_type, deviceId):
+        """whether the channel is assigned as our master channels are, with
+        this channel id.  The device can't be asked for the period and
+        frequency, those are taken to be ours too."""
+        if status['status'] & 0xf0 != ANT_POWER_PROFILE_POwER_PAGE or (status['status'] >> 2) & 0x3 != ANT_NETWORK:
+            return False
+        channelId = self.get_channel_id(channel)
+        return channelId['device_number'] == deviceId and channelId['device_type_id'] == device_type
 
     def close(self):
         self.stopped = True
-        self.close_channel(0)
+        for channel in self.openChannels:
+            self.close_channel(channel)
 
     def wait_tx(self):
+        """Waits until the device has transmitted on some channel, so the next
+        page loaded on it goes out in its next slot, and returns the set of
+        channels that transmitted.  If several event_tx have queued up, we're
+        behind, so this reads through to the latest.  Target power pages
+        from the head unit are handed on through targetPower on the way."""
+        started = monotonic()
         self.sp.setTimeout(0.05)
 
-        while 1:
+        transmitted = set()
+        while not transmitted or self.data_waiting():
             try:
                 resp = self.receive_message(wait=2.0)
                 if not resp:
@@ -59,96 +133,283 @@ class AntBroadcaster(ant.Ant):
 
                 if resp.name == 'calibration_request':
                     print("Ignoring request for calibration")
+                if resp.name == 'target_power':
+                    self.targetPower.publish(resp['target_watts'], monotonic())
                 if resp.name == 'event_tx':
-                    return
+                    transmitted.add(resp['channel'])
 
             except ant.AntNoDataException:
                 pass
 
+        now = monotonic()
+        self.txWait.record(now - started)
+        for channel in transmitted:
+            self.channelStats[channel].record(now)
+        return transmitted
 
-class PowerBroadcaster(AntBroadcaster):
-    def __init__(self, network_key, Debug):
-        AntBroadcaster.__init__(self, network_key, Debug, device_type=ANT_DEVICE_TYPE_POWER)
-        self.Debug = Debug
+
+class EventCounter:
+    """Whole events happening at a varying rate, such as heart beats or
+    wheel revolutions, with the time of the last in the 1/1024s units ANT+
+    sensor pages use"""
+
+    def __init__(self):
+        self.count = 0
+        self.lastEvent = 0.0
+        self.phase = 0.0  # fraction of the way to the next event
+        self.lastUpdate = None
+
+    def update(self, now, ratePerSec):
+        if self.lastUpdate is not None and ratePerSec > 0:
+            self.phase += (now - self.lastUpdate) * ratePerSec
+            while self.phase >= 1:
+                self.phase -= 1
+                self.count += 1
+                self.lastEvent = now - self.phase / ratePerSec
+        self.lastUpdate = now
+
+    def eventTime(self):
+        return int(self.lastEvent * 1024)
+
+
+class PowerChannel:
+    "standard power-only pages, for a power meter"
+    deviceType = ANT_DEVICE_TYPE_POWER
+    period = ANT_CHANNEL_PERIOD
+
+    def __init__(self, channel=0):
         self.power_accum = 0
         self.event_counter = 0
-        self.lastPowerUpdate = -1
-        self.lastCadenceUpdate = -1
 
-    def broadcastPower(self, power=0, cadence=0):
-        self.power_accum += power
         balance = 50
+        # channel, page, event counter, balance, cadence, accumulated power (2), instant power (2)
+        self.powerPage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data,
+                                              [channel, ANT_POWER_PROFILE_POwER_PAGE, 0, 0x80 | balance, 0, 0, 0, 0, 0])
+
+    def load(self, power, cadence):
+        self.power_accum += power
 
-        data = [
-            ANT_POWER_PROFILE_POwER_PAGE,
-            (self.event_counter + 128) & 0xff,
-            0x80 | balance,
-            int(cadence),  # 0xff, # instant cadence
-            int(self.power_accum) & 0xff,
-            (int(self.power_accum) >> 8) & 0xff,
-            int(power) & 0xff,
-            (int(power) >> 8) & 0xff
-        ]
+        page = self.powerPage
+        page.set(2, self.event_counter + 128)
+        page.set(4, int(cadence))  # instant cadence
+        page.set_uint16_le(5, int(self.power_accum))
+        page.set_uint16_le(7, int(power))
 
         self.event_counter = (self.event_counter + 1) % 0xff
+        return page
 
-        if self.Debug or (power != self.lastPowerUpdate) or (cadence != self.lastCadenceUpdate):
-            print("Sending data for device[%s]: %40s for power[%s] cadence[%s]" % (
-                self.deviceId, str(data), power, cadence))
-        self.send_broadcast_data(0, data)
-        self.lastPowerUpdate = power
-        self.lastCadenceUpdate = cadence
-        self.wait_tx()
+    def page(self, model):
+        return self.load(model.power, model.cadence)
 
 
-class FitnessEquipmentBroadcaster(AntBroadcaster):
-    def __init__(self, filename, NetworkKey, Debug):
-        AntBroadcaster.__init__(self, NetworkKey, Debug, deviceType=ANT_DEVICE_TYPE_FITNESS_EQUIPMENT)
+class HeartRateChannel:
+    "heart rate monitor data pages, beats paced to the bike's heart rate reading"
+    deviceType = ANT_DEVICE_TYPE_HEART_RATE
+    period = ANT_HEART_RATE_CHANNEL_PERIOD
 
-    def broadcastGeneralDataPage(self, elapsedTimeSeconds, distanceMetres, speedMetresPerSec, heartRate):
-        # general data page for a FitnessEquipment. This doesn't need an event counter
+    def __init__(self, channel):
+        self.beats = EventCounter()
+        self.messages = 0
+        # channel, page (and toggle bit), reserved (3), beat time (2), beat count, heart rate
+        self.heartRatePage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [channel, 0, 0xff, 0xff, 0xff, 0, 0, 0, 0])
 
-        # speed in units of 0.001m/s, rollover at 65534
-        speedInFunnyUnits = speedMetresPerSec * 1000
-        speedLsb = speedInFunnyUnits & 0xff
-        speedMsb = (speedInFunnyUnits >> 8) & 0xff
+    def page(self, model):
+        heartRate = model.heartRate or 0
+        self.beats.update(monotonic(), heartRate / 60.0)
 
-        capabilitiesBitField = (
-                2 << 4 |  # HR data source is 5kHz HRM
-                1 << 2 |  # distance transmission is enabled
-                1  # speed is virtual, not real
-        )
+        page = self.heartRatePage
+        page.set(1, (self.messages // 4 % 2) << 7)  # the toggle bit flips every four messages
+        page.set_uint16_le(5, self.beats.eventTime())
+        page.set(7, self.beats.count)
+        page.set(8, heartRate)
+        self.messages += 1
+        return page
 
-        data = [
-            ANT_FITNESS_EQUIPMENT_PROFILE_GENERAL_DATA_PAGE,
-            ANT_FITNESS_EQUIPMENT_TYPE_STATIONARY_BIKE,
-            (elapsedTimeSeconds % 64) * 4,  # time in units of 0.25s, rollover at 64s
-            distanceMetres % 256,  # distance in metres, rollover at 256m
-            speedLsb,
-            speedMsb,
-            capabilitiesBitField
-        ]
 
-        self.send_broadcast_data(0, data)
-        self.wait_tx()
+class SpeedCadenceChannel:
+    "combined speed and cadence sensor pages, revolutions paced to the bike's readings"
+    deviceType = ANT_DEVICE_TYPE_SPEED_CADENCE
+    period = ANT_SPEED_CADENCE_CHANNEL_PERIOD
 
-    def broadcastPower(self, power=0, cadence=0):
-        self.power_accum += power
-        balance = 50
+    def __init__(self, channel):
+        self.crank = EventCounter()
+        self.wheel = EventCounter()
+        # channel, crank event time (2), crank revolutions (2), wheel event time (2), wheel revolutions (2)
+        self.speedCadencePage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [channel, 0, 0, 0, 0, 0, 0, 0, 0])
 
-        data = [
-            ANT_POWER_PROFILE_POwER_PAGE,
-            (self.event_counter + 128) & 0xff,
-            0x80 | balance,
-            int(cadence),  # 0xff, # instant cadence
-            int(self.power_accum) & 0xff,
-            (int(self.power_accum) >> 8) & 0xff,
-            int(power) & 0xff,
-            (int(power) >> 8) & 0xff
-        ]
+    def page(self, model):
+        now = monotonic()
+        self.crank.update(now, model.cadence / 60.0)
+        metresPerSec = (model.speed or 0) / 36.0  # from 0.1km/h
+        self.wheel.update(now, metresPerSec / WHEEL_CIRCUMFERENCE_METRES)
 
-        self.event_counter = (self.event_counter + 1) % 0xff
+        page = self.speedCadencePage
+        page.set_uint16_le(1, self.crank.eventTime())
+        page.set_uint16_le(3, self.crank.count)
+        page.set_uint16_le(5, self.wheel.eventTime())
+        page.set_uint16_le(7, self.wheel.count)
+        return page
+
+
+class PowerBroadcaster(AntBroadcaster):
+    def __init__(self, network_key, Debug, port=None, deviceNumberBase=DEVICE_NUMBER_BASE):
+        AntBroadcaster.__init__(self, network_key, Debug, device_type=ANT_DEVICE_TYPE_POWER, port=port,
+                                deviceNumberBase=deviceNumberBase)
+        self.Debug = Debug
+        self.powerChannel = PowerChannel(0)
+        self.lastPowerUpdate = -1
+        self.lastCadenceUpdate = -1
+        self.lastWritten = None
+
+    def broadcastPower(self, power=0, cadence=0):
+        page = self.powerChannel.load(power, cadence)
 
-        print("sending standard data: " + str(data))
-        self.send_broadcast_data(0, data)
+        if self.Debug or (power != self.lastPowerUpdate) or (cadence != self.lastCadenceUpdate):
+            print("Sending data for device[%s]: %40s for power[%s] cadence[%s]" % (
+                self.deviceId, str(page.data()[1:]), power, cadence))
+        self.send_frame(page)
+        self.lastWritten = monotonic()
+        self.lastPowerUpdate = power
+        self.lastCadenceUpdate = cadence
         self.wait_tx()
+
+    def broadcast(self, model):
+        self.broadcastPower(model.power, model.cadence)
+
+
+class MultiChannelBroadcaster(AntBroadcaster):
+    """Broadcasts several profiles from one device, each on its own channel,
+    for example [PowerChannel, HeartRateChannel, SpeedCadenceChannel].  The
+    first is the primary: broadcast() returns once per primary channel
+    period, loading the next page on each of the other channels as their
+    event_tx come in meanwhile, all on the calling thread."""
+
+    def __init__(self, network_key, Debug, channelTypes, port=None, deviceNumberBase=DEVICE_NUMBER_BASE):
+        AntBroadcaster.__init__(self, network_key, Debug, device_type=channelTypes[0].deviceType, port=port,
+                                period=channelTypes[0].period, deviceNumberBase=deviceNumberBase)
+        self.Debug = Debug
+        self.channels = [channelTypes[0](0)]
+        for channel, channelType in enumerate(channelTypes[1:], 1):
+            self.open_broadcast_channel(channel, channelType.deviceType, channelType.period)
+            self.channels.append(channelType(channel))
+        self.due = set(range(len(self.channels)))
+        self.lastWritten = None
+
+    def broadcast(self, model):
+        while True:
+            for channel in sorted(self.due):
+                page = self.channels[channel].page(model)
+                if self.Debug:
+                    print("Sending data on channel[%s]: %40s" % (channel, str(page.data()[1:])))
+                self.send_frame(page)
+                if channel == 0:
+                    self.lastWritten = monotonic()
+            self.due = self.wait_tx()
+            if 0 in self.due:
+                return
+
+
+class FitnessEquipmentChannel:
+    """FE-C pages for a trainer: general data, the stationary bike and
+    trainer pages, and the manufacturer and product pages, interleaved as
+    SCHEDULE lays out.  Everything taken from the bike's status record is
+    written into the pages once per sample, so a slot only picks its page
+    and, for the trainer page, moves the power event on."""
+    deviceType = ANT_DEVICE_TYPE_FITNESS_EQUIPMENT
+    period = ANT_FITNESS_EQUIPMENT_CHANNEL_PERIOD
+
+    # each data page at least every four slots, the common pages once a cycle, about every 16s
+    SCHEDULE = (ANT_FITNESS_EQUIPMENT_PROFILE_GENERAL_DATA_PAGE,
+                ANT_FITNESS_EQUIPMENT_PROFILE_TRAINER_DATA_PAGE,
+                ANT_FITNESS_EQUIPMENT_PROFILE_GENERAL_DATA_PAGE,
+                ANT_FITNESS_EQUIPMENT_PROFILE_STATIONARY_BIKE_DATA_PAGE) * 16 + (
+                   ANT_COMMON_MANUFACTURER_PAGE,
+                   ANT_COMMON_PRODUCT_PAGE)
+
+    def __init__(self, channel):
+        inUse = FE_STATE_IN_USE << 4
+        self.generalPage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [
+            # channel, page, equipment type, elapsed time, distance, speed (2), heart rate, capabilities and state
+            channel, ANT_FITNESS_EQUIPMENT_PROFILE_GENERAL_DATA_PAGE, ANT_FITNESS_EQUIPMENT_TYPE_TRAINER,
+            0, 0, 0, 0, 0xff, inUse | FE_CAPABILITY_DISTANCE | FE_CAPABILITY_VIRTUAL_SPEED])
+        self.stationaryBikePage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [
+            # channel, page, reserved (3), cadence, instant power (2), state
+            channel, ANT_FITNESS_EQUIPMENT_PROFILE_STATIONARY_BIKE_DATA_PAGE, 0xff, 0xff, 0xff, 0, 0, 0, inUse])
+        self.trainerPage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [
+            # channel, page, event counter, cadence, accumulated power (2), instant power (12 bits) and status, flags and state
+            channel, ANT_FITNESS_EQUIPMENT_PROFILE_TRAINER_DATA_PAGE, 0, 0, 0, 0, 0, 0, inUse])
+        manufacturerPage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [
+            # channel, page, reserved (2), hardware revision, manufacturer (2), model (2)
+            channel, ANT_COMMON_MANUFACTURER_PAGE, 0xff, 0xff, HARDWARE_REVISION, 0, 0, 0, 0])
+        manufacturerPage.set_uint16_le(5, MANUFACTURER_ID)
+        manufacturerPage.set_uint16_le(7, MODEL_NUMBER)
+        productPage = ant.AntFrameTemplate(ant.ANT_Broadcast_Data, [
+            # channel, page, reserved, supplemental software revision, software revision, serial number (4), none
+            channel, ANT_COMMON_PRODUCT_PAGE, 0xff, 0xff, SOFTWARE_REVISION, 0xff, 0xff, 0xff, 0xff])
+
+        pages = {ANT_FITNESS_EQUIPMENT_PROFILE_GENERAL_DATA_PAGE: self.generalPage,
+                 ANT_FITNESS_EQUIPMENT_PROFILE_STATIONARY_BIKE_DATA_PAGE: self.stationaryBikePage,
+                 ANT_FITNESS_EQUIPMENT_PROFILE_TRAINER_DATA_PAGE: self.trainerPage,
+                 ANT_COMMON_MANUFACTURER_PAGE: manufacturerPage,
+                 ANT_COMMON_PRODUCT_PAGE: productPage}
+        self.cycle = [pages[number] for number in self.SCHEDULE]
+        self.slot = 0
+        self.sample = None
+        self.power = 0
+        self.events = 0
+        self.accumulatedPower = 0
+        self.distanceMetres = 0.0
+        self.started = None
+
+    def update(self, model):
+        "writes a new sample into the pages"
+        power = min(int(model.power), 0xfff)  # the trainer page only has 12 bits for it
+        cadence = int(model.cadence) & 0xff
+        speed = model.speed or 0  # 0.1km/h
+        heartRate = model.heartRate or 0
+
+        if self.sample is None:
+            self.started = model.timestamp
+        else:
+            # the bike's own distance only moves in 100m steps, too coarse for the page
+            self.distanceMetres += (self.sample.speed or 0) / 36.0 * (model.timestamp - self.sample.timestamp)
+        elapsed = model.elapsedTime if model.elapsedTime is not None else model.timestamp - self.started
+
+        page = self.generalPage
+        page.set(3, int(elapsed * 4))  # 0.25s, rolling over every 64s
+        page.set(4, int(self.distanceMetres))  # rolling over every 256m
+        page.set_uint16_le(5, speed * 1000 // 36)  # 0.001m/s
+        page.set(7, heartRate or 0xff)
+        page.set(8, FE_STATE_IN_USE << 4 | FE_CAPABILITY_DISTANCE | FE_CAPABILITY_VIRTUAL_SPEED |
+                 (FE_HEART_RATE_SOURCE_HAND_CONTACT if heartRate else 0))
+
+        page = self.stationaryBikePage
+        page.set(5, cadence)
+        page.set_uint16_le(6, power)
+
+        self.trainerPage.set(3, cadence)
+        self.trainerPage.set_uint16_le(6, power)
+        self.power = power
+        self.sample = model
+
+    def page(self, model):
+        if model is not self.sample:
+            self.update(model)
+
+        page = self.cycle[self.slot]
+        self.slot = (self.slot + 1) % len(self.cycle)
+        if page is self.trainerPage:
+            self.events += 1
+            self.accumulatedPower += self.power
+            page.set(2, self.events)
+            page.set_uint16_le(4, self.accumulatedPower)
+        return page
+
+
+class FitnessEquipmentBroadcaster(MultiChannelBroadcaster):
+    """Broadcasts the bike as an FE-C trainer, for head units that take one
+    in place of a power meter, and that can set its power."""
+
+    def __init__(self, network_key, Debug, port=None, deviceNumberBase=DEVICE_NUMBER_BASE):
+        MultiChannelBroadcaster.__init__(self, network_key, Debug, [FitnessEquipmentChannel], port=port,
+                                         deviceNumberBase=deviceNumberBase)
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+"""Record and replay of the serial traffic to the ANT device and the bike.
+
+A capture log is a sequence of records, each a RECORD header followed by
+the bytes read or written:
+  timestamp   double, seconds on the monotonic clock since the log was opened
+  port        ANT_PORT or KETTLER_PORT, or SETTINGS
+  direction   READ or WRITTEN, as seen by this program
+  length      of the data that follows
+
+A SETTINGS record, first in the log, holds what the ANT writer was set up
+with as JSON, so that replay sets it up the same way: channelTypes, the
+names of the channel classes in components.ant_broadcaster.  A log without
+one replays as a power meter.
+
+To replay a log through the whole pipeline, faster than real time by the
+given factor (0 for no delays at all):
+
+  python -m components.capture capture.log [speed]
+"""
+
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from components.pseudo_terminal import open_raw_pty
+from components.timing import monotonic
+
+RECORD = struct.Struct('<dBBH')
+
+ANT_PORT = 0
+KETTLER_PORT = 1
+SETTINGS = 2
+
+# how much later than recorded the program may write before replay counts the write as differing and moves on
+WRITE_TIMEOUT_SECS = 2.0
+
+READ = 0
+WRITTEN = 1
+
+
+class CaptureLog:
+    "Appends records to a capture log, from any thread"
+
+    def __init__(self, path, settings=None):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.t0 = monotonic()
+        if settings is not None:
+            self.append(SETTINGS, WRITTEN, json.dumps(settings, sort_keys=True).encode('utf-8'))
+
+    def append(self, port, direction, data):
+        record = RECORD.pack(monotonic() - self.t0, port, direction, len(data)) + bytes(data)
+        with self.lock:
+            # the ANT thread can still be closing its channel after the log is closed
+            if not self.file.closed:
+                self.file.write(record)
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path):
+    "yields (timestamp, port, direction, data) for each record in a capture log"
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, port, direction, length = RECORD.unpack(header)
+            yield timestamp, port, direction, f.read(length)
+
+
+class CapturingSerial:
+    """Wraps a serial port, logging everything read from or written to it.
+    Anything else is passed straight through to the port."""
+
+    def __init__(self, serial_port, log, port):
+        self.serial_port = serial_port
+        self.log = log
+        self.port = port
+
+    def read(self, n=1):
+        data = self.serial_port.read(n)
+        if data:
+            self.log.append(self.port, READ, data)
+        return data
+
+    def write(self, data):
+        self.log.append(self.port, WRITTEN, data)
+        return self.serial_port.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.serial_port, name)
+
+
+class ReplayPort(threading.Thread):
+    """Plays back one port of a capture log on a pseudo-terminal, which the
+    program under test opens as if it were the real device.
+
+    Replay follows the program rather than the clock alone: at each recorded
+    write it waits for the program to write as many bytes, and the reads
+    after it are delivered with their recorded delays, divided by speed.
+    Writes that differ from the recording are counted, as are writes that
+    come short, or over WRITE_TIMEOUT_SECS later than recorded, which replay
+    then moves on from."""
+
+    def __init__(self, records, speed=1.0):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.records = records
+        self.speed = speed
+        self.master, self.slave, self.portName = open_raw_pty()
+        self.written = b''
+        self.differingWrites = 0
+        self.finished = threading.Event()
+
+    def awaitWrite(self, expected, deadline):
+        while len(self.written) < len(expected):
+            remaining = deadline - monotonic()
+            readable = remaining > 0 and select.select([self.master], [], [], remaining)[0]
+            if not readable:
+                self.differingWrites += 1
+                self.written = b''
+                return
+            self.written += os.read(self.master, 4096)
+        if self.written[:len(expected)] != expected:
+            self.differingWrites += 1
+        self.written = self.written[len(expected):]
+
+    def run(self):
+        base = (monotonic(), 0.0)
+        for timestamp, direction, data in self.records:
+            if direction == WRITTEN:
+                due = base[0] + (timestamp - base[1]) / self.speed if self.speed else monotonic()
+                self.awaitWrite(data, max(due, monotonic()) + WRITE_TIMEOUT_SECS)
+                base = (monotonic(), timestamp)
+            else:
+                if self.speed:
+                    delay = (timestamp - base[1]) / self.speed - (monotonic() - base[0])
+                    if delay > 0:
+                        time.sleep(delay)
+                os.write(self.master, data)
+        self.finished.set()
+
+        # the program may still be writing
+        while True:
+            os.read(self.master, 4096)
+
+
+def replay(path, speed):
+    """Runs the ANT writer and the Kettler input loop against a capture log,
+    set up as the log's SETTINGS record says, then prints how they fared"""
+    from serial import Serial
+
+    from components import ant_broadcaster
+    from components.ant_writer import PowerWriter
+    from components.kettler_serial import Kettler
+    from components.timing import PollScheduler
+
+    records = list(read_capture(path))
+    settings = {}
+    for t, p, d, data in records:
+        if p == SETTINGS:
+            settings = json.loads(data.decode('utf-8'))
+    channelTypes = [getattr(ant_broadcaster, name) for name in settings.get('channelTypes', ['PowerChannel'])]
+    print("Replaying as [%s]" % ", ".join([t.__name__ for t in channelTypes]))
+
+    antReplay = ReplayPort([(t, d, data) for t, p, d, data in records if p == ANT_PORT], speed)
+    kettlerReplay = ReplayPort([(t, d, data) for t, p, d, data in records if p == KETTLER_PORT], speed)
+    antReplay.start()
+    kettlerReplay.start()
+
+    started = monotonic()
+    antWriter = PowerWriter(transmitIntervalMillis=250,
+                            networkKey=[0] * 8,
+                            syncToEventTx=True,
+                            port=Serial(antReplay.portName, baudrate=57600, rtscts=1),
+                            channelTypes=channelTypes if channelTypes != [ant_broadcaster.PowerChannel] else None)
+    print("ANT device initialised after %.3fs" % (monotonic() - started))
+
+    kettler = Kettler(Serial(kettlerReplay.portName, baudrate=57600, timeout=1))
+
+    def readFromKettler():
+        for model in kettler.readModels(PollScheduler(antWriter.txStats), antWriter.targetPower):
+            if model is not None:
+                antWriter.updateModel(model)
+            if kettlerReplay.finished.isSet():
+                break
+
+    antThread = threading.Thread(target=antWriter.start)
+    antThread.setDaemon(True)
+    antThread.start()
+    kettlerThread = threading.Thread(target=readFromKettler)
+    kettlerThread.setDaemon(True)
+    kettlerThread.start()
+
+    antReplay.finished.wait()
+    kettlerReplay.finished.wait()
+    antWriter.stop()
+    antThread.join(5)
+
+    print("Replayed [%s] records in %.3fs" % (len(records), monotonic() - started))
+    print("Kettler rpc: %s" % kettler.rpcEngine)
+    print("Writes differing from the capture: ANT[%s] Kettler[%s]" % (
+        antReplay.differingWrites, kettlerReplay.differingWrites))
+
+
+if __name__ == "__main__":
+    replay(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+"""Finds the Kettler and the ANT device among the serial ports.
+
+Every candidate port is probed at once, each on its own thread, and each
+port ends up with at most one role: a port that answered as one device is
+never tried as the other.  What was found, the ports, the ANT device's baud
+rate and the Kettler's ID, is kept in a small JSON state file and tried
+first the next time, so a restart with nothing moved needs one probe per
+device rather than a search:
+
+  found = discover(STATE_PATH)
+  antPort = open_ant(found[ANT])
+  kettler = kettler_serial.open_kettler_usb(found[KETTLER].port)
+"""
+
+import json
+import os
+import threading
+
+from serial import Serial
+
+from ant_support import ant
+from components import kettler_serial
+from components.timing import monotonic
+
+STATE_PATH = os.path.expanduser('~/.kettler_ant_state.json')
+
+KETTLER = 'kettler'
+ANT = 'ant'
+
+PROBE_TIMEOUT_SECS = 0.3  # per baud rate for the ANT device, the Kettler has its own RPC timeout
+ANT_BAUDRATES = [57600, 19200, 38400, 115200]
+
+CAPABILITIES_REQUEST = bytearray([0xa4, 2, ant.ANT_Request_Message, 0, ant.ANT_Capabilities])
+CAPABILITIES_REQUEST.append(0xa4 ^ 2 ^ ant.ANT_Request_Message ^ 0 ^ ant.ANT_Capabilities)
+
+
+class Found:
+    "a device found on a port: the baud rate for an ANT device, the ID for a Kettler"
+
+    def __init__(self, role, port, baudrate=None, deviceId=None, cached=False):
+        self.role = role
+        self.port = port
+        self.baudrate = baudrate
+        self.deviceId = deviceId
+        self.cached = cached  # found where the state file said it would be
+
+    def state(self):
+        if self.role == ANT:
+            return {'port': self.port, 'baudrate': self.baudrate}
+        return {'port': self.port, 'id': self.deviceId}
+
+    def __str__(self):
+        return "%s at [%s]%s%s" % (self.role, self.port,
+                                  " baudrate[%s]" % self.baudrate if self.baudrate else "",
+                                  " id[%s]" % self.deviceId if self.deviceId else "")
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    try:
+        with open(path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+    except (IOError, OSError) as e:
+        print("Couldn't save discovered devices to [%s]: %s" % (path, e))
+
+
+def has_capabilities_reply(data):
+    "whether data holds a whole, valid ANT capabilities message"
+    start = data.find(b'\xa4')
+    while 0 <= start and start + 4 <= len(data):
+        length = data[start + 1]
+        end = start + length + 4
+        if end <= len(data) and data[start + 2] == ant.ANT_Capabilities:
+            checksum = 0
+            for b in data[start:end]:
+                checksum ^= b
+            if checksum == 0:
+                return True
+        start = data.find(b'\xa4', start + 1)
+    return False
+
+
+def probe_ant(name, baudrates):
+    "the baud rate the ANT device on the port answers at, or None"
+    port = Serial(name, baudrate=baudrates[0], rtscts=1, timeout=0)
+    try:
+        for baudrate in baudrates:
+            port.setBaudrate(baudrate)
+            port.flushInput()
+            port.write(bytes(CAPABILITIES_REQUEST))
+            received = bytearray()
+            deadline = monotonic() + PROBE_TIMEOUT_SECS
+            while monotonic() < deadline:
+                port.setTimeout(max(0, deadline - monotonic()))
+                received += bytearray(port.read(max(1, port.inWaiting())))
+                if has_capabilities_reply(received):
+                    return baudrate
+        return None
+    finally:
+        port.close()
+
+
+def ant_baudrates(name, first=None):
+    "the baud rates to try for an ANT device, most likely first"
+    baudrates = list(ANT_BAUDRATES)
+    try:
+        likely = [first, ant.guess_ant_baudrate(name)]
+    except KeyError:
+        likely = [first]
+    for baudrate in reversed(likely):
+        if baudrate in baudrates:
+            baudrates.remove(baudrate)
+            baudrates.insert(0, baudrate)
+    return baudrates
+
+
+def probe(name, roles, hint=None, debug=False):
+    "tries the port as each of roles in turn, returning what it turned out to be, or None"
+    for role in roles:
+        try:
+            if role == ANT:
+                baudrate = probe_ant(name, ant_baudrates(name, hint and hint.get('baudrate')))
+                if baudrate:
+                    return Found(ANT, name, baudrate=baudrate)
+            else:
+                kettlerId = kettler_serial.probe_kettler_usb(name, debug)
+                if kettlerId:
+                    return Found(KETTLER, name, deviceId=kettlerId)
+        except Exception as e:
+            if debug:
+                print("Probing [%s] as %s failed: %s" % (name, role, e))
+    return None
+
+
+def probe_all(jobs, debug=False):
+    "runs probe() for each (port, roles, hint) at once, returning what was found"
+    results = []
+    threads = [threading.Thread(target=lambda job: results.append(probe(*job, debug=debug)), args=(job,),
+                                name="probe-" + os.path.basename(job[0]))
+               for job in jobs]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [r for r in results if r is not None]
+
+
+def candidates():
+    """serial ports that could be either device, one name for each, the
+    roles to try them in the likeliest order"""
+    antNames = ant.find_ant_serial_ports()
+    seen = set()
+    result = []
+    # stable by-id names first, so they win over the ttyUSB they point at
+    for name in antNames + kettler_serial.kettler_usb_candidates():
+        real = os.path.realpath(name)
+        if real in seen:
+            continue
+        seen.add(real)
+        result.append((name, [ANT, KETTLER] if name in antNames else [KETTLER, ANT]))
+    return result
+
+
+def discover(statePath=STATE_PATH, debug=False):
+    """{role: Found} for the Kettler and the ANT device, trying where they
+    were last time before searching every port.  A role is missing if
+    nothing answered for it."""
+    started = monotonic()
+    state = load_state(statePath)
+
+    found = {}
+    cachedJobs = [(state[role]['port'], [role], state[role]) for role in (ANT, KETTLER)
+                  if role in state and os.path.exists(state[role]['port'])]
+    for device in probe_all(cachedJobs, debug):
+        device.cached = True
+        found[device.role] = device
+
+    missing = [role for role in (ANT, KETTLER) if role not in found]
+    if missing:
+        taken = set([os.path.realpath(device.port) for device in found.values()])
+        jobs = [(name, [role for role in roles if role in missing], None) for name, roles in candidates()
+                if os.path.realpath(name) not in taken]
+        print("Probing [%s] serial ports for %s" % (len(jobs), " and ".join(missing)))
+        for device in sorted(probe_all(jobs, debug), key=lambda d: d.port):
+            found.setdefault(device.role, device)
+
+    for device in found.values():
+        print("Found %s%s" % (device, " as cached" if device.cached else ""))
+    print("Discovery took %.2fs" % (monotonic() - started))
+    if found:
+        # a device not found this time keeps its entry, for when it's back
+        for role, device in found.items():
+            state[role] = device.state()
+        save_state(statePath, state)
+    return found
+
+
+def open_ant(device):
+    "an open serial port for the ANT device found, at the baud rate it answered at"
+    return Serial(device.port, baudrate=device.baudrate, rtscts=1)
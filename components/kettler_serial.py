@@ -1,9 +1,24 @@
 import os
 import re
+import select
+import time
 
 from serial import Serial, PARITY_NONE
 
 from components.ant import PowerModel
+from components.timing import LatencyHistogram, monotonic
+
+RPC_TIMEOUT_MILLIS = 250
+# how long after a timeout whatever arrives is taken for the late reply and dropped
+RPC_GRACE_MILLIS = 100
+
+# the range of power the bike can be set to, in steps of POWER_STEP
+MIN_POWER = 25
+MAX_POWER = 400
+POWER_STEP = 5
+
+# what a Kettler replies to ID: two letters, two letters or digits, then four digits, such as SF1B2345
+KETTLER_ID = re.compile(r'^[A-Z]{2}[0-9A-Z]{2}[0-9]{4}$')
 
 
 def find_kettler_bluetooth(debug):
@@ -33,37 +48,114 @@ def find_kettler_bluetooth(debug):
     raise Exception("No serial port found")
 
 
+def kettler_usb_candidates():
+    return ["/dev/" + f for f in sorted(os.listdir("/dev/")) if re.match(r'.*USB.*', f)]
+
+
+def open_kettler_usb(serial_name, debug=False):
+    "returns a Kettler on the serial port, whether or not one is there"
+    serial_port = Serial(serial_name,
+                         baudrate=57600,
+                         parity=PARITY_NONE,
+                         timeout=1)
+    return Kettler(serial_port, debug)
+
+
+def probe_kettler_usb(serial_name, debug=False):
+    """returns the ID of the Kettler on the serial port, leaving the port
+    closed, or None if whatever is there doesn't reply to ID as a Kettler
+    does, see KETTLER_ID"""
+    kettler = open_kettler_usb(serial_name, debug)
+    try:
+        kettler_id = kettler.getId().strip()
+    finally:
+        kettler.close()
+    if KETTLER_ID.match(kettler_id):
+        return kettler_id
+    if debug and kettler_id:
+        print("[%s] replied to ID with [%s], which isn't a Kettler ID" % (serial_name, kettler_id))
+    return None
+
+
 def find_kettler_usb(debug):
-    "returns a Kettler instance for the first Kettler serial port found that replies to ID and ST"
+    "returns a Kettler instance for the first Kettler serial port found that replies to ID"
 
     print("Looking for serial ports for a Kettler device...")
 
-    candidates = [f for f in os.listdir("/dev/") if
-                  re.match(r'.*USB.*', f)]
+    candidates = kettler_usb_candidates()
 
     print("Found %s candidates" % len(candidates))
 
-    for c in candidates:
-        print("Trying: [%s]..." % c)
+    for serial_name in candidates:
+        print("Trying: [%s]..." % serial_name)
         try:
-            serial_name = "/dev/" + c
-            serial_port = Serial(serial_name,
-                                 baudrate=57600,
-                                 parity=PARITY_NONE,
-                                 timeout=1)
-            kettler = Kettler(serial_port, debug)
-            kettler_id = kettler.getId()
-            if len(kettler_id) > 0:
+            kettler_id = probe_kettler_usb(serial_name, debug)
+            if kettler_id:
                 print("Connected to Kettler [%s] at [%s]" % (kettler_id, serial_name))
-                return kettler
+                return open_kettler_usb(serial_name, debug)
         except Exception as e:
-            print("Failed to connect to [%s]")
+            print("Failed to connect to [%s]" % serial_name)
             print(e)
             pass
 
     raise Exception("No serial port found")
 
 
+def find_all_kettlers_usb(debug, exclude=()):
+    """returns {Kettler id: serial port name} for every Kettler serial port
+    that replies to ID with a Kettler ID, leaving the ports closed.  Ports
+    in exclude, such as ANT devices, aren't tried."""
+
+    found = {}
+    for serial_name in kettler_usb_candidates():
+        if serial_name in exclude or os.path.realpath(serial_name) in exclude:
+            continue
+        try:
+            kettler_id = probe_kettler_usb(serial_name, debug)
+            if kettler_id:
+                print("Found Kettler [%s] at [%s]" % (kettler_id, serial_name))
+                found[kettler_id] = serial_name
+        except Exception as e:
+            print("Failed to connect to [%s]: %s" % (serial_name, e))
+
+    return found
+
+
+def parse_status(statusLine):
+    """Parses a reply to ST into a PowerModel, or returns None if it isn't one.
+
+    heartRate cadence speed distanceInFunnyUnits destPower energy timeElapsed realPower
+    000 052 095 000 030 0001 00:12 030
+
+    The fixed layout above is sliced directly, anything else falls back to
+    splitting on whitespace."""
+    try:
+        if len(statusLine) == 34 and statusLine[27] == ':' and statusLine[30] == ' ':
+            return PowerModel(power=int(statusLine[31:34]),
+                              cadence=int(statusLine[4:7]),
+                              heartRate=int(statusLine[0:3]),
+                              speed=int(statusLine[8:11]),
+                              distance=int(statusLine[12:15]),
+                              destPower=int(statusLine[16:19]),
+                              energy=int(statusLine[20:24]),
+                              elapsedTime=int(statusLine[25:27]) * 60 + int(statusLine[28:30]))
+
+        segments = statusLine.split()
+        if len(segments) == 8:
+            minutes, seconds = segments[6].split(':')
+            return PowerModel(power=int(segments[7]),
+                              cadence=int(segments[1]),
+                              heartRate=int(segments[0]),
+                              speed=int(segments[2]),
+                              distance=int(segments[3]),
+                              destPower=int(segments[4]),
+                              energy=int(segments[5]),
+                              elapsedTime=int(minutes) * 60 + int(seconds))
+    except ValueError:
+        pass
+    return None
+
+
 def close_safely(thing):
     try:
         thing.close()
@@ -71,38 +163,243 @@ def close_safely(thing):
         print("Failed to close [%s]: %s" % (str(thing), str(e)))
 
 
+class KettlerRpc:
+    """Request/reply over the Kettler serial port without blocking in
+    readline.  Replies are framed into lines from whatever bytes are
+    waiting, each request times out on its own, and a new request can be
+    written before the last reply has been dealt with."""
+
+    def __init__(self, serial_port, timeoutMillis=RPC_TIMEOUT_MILLIS, graceMillis=RPC_GRACE_MILLIS):
+        self.serial_port = serial_port
+        self.timeoutSecs = timeoutMillis / 1000.0
+        self.graceSecs = graceMillis / 1000.0
+        self.buffer = ''
+        self.lines = []
+        self.inFlight = []  # (message, time sent), oldest first
+        self.latency = LatencyHistogram()
+        self.lastLatency = None
+        self.lastReceived = None
+        self.lastRequest = None
+        self.timeouts = 0
+        self.lateLines = 0
+        self.started = monotonic()
+
+    def send(self, message):
+        self.serial_port.write(message)
+        self.serial_port.flush()
+        self.inFlight.append((message, monotonic()))
+
+    def __readWaiting(self, waitSecs):
+        "reads whatever is waiting, waiting at most waitSecs for something to arrive"
+        if not self.serial_port.inWaiting():
+            readable, writable, errored = select.select([self.serial_port], [], [], max(0, waitSecs))
+            if not readable:
+                return
+        data = self.serial_port.read(max(1, self.serial_port.inWaiting()))
+        if not data:
+            return
+        self.buffer += data
+        if '\n' in self.buffer:
+            received = monotonic()
+            lines = self.buffer.split('\n')
+            self.buffer = lines.pop()
+            self.lines += [(l.rstrip(), received) for l in lines]  # rstrip trims the trailing \r too
+
+    def receive(self):
+        """Returns the reply to the oldest request in flight, or None if it
+        timed out.  After a timeout, lines arriving within the grace period
+        are dropped, counted in lateLines, and then input is flushed, so
+        that a late reply isn't taken for the answer to the next request.
+        A reply later than timeout and grace together still would be, as
+        the bike's replies carry nothing to tell which request they answer.
+        Replies to other requests already in flight are dropped too, and
+        those requests time out in turn.  lastReceived is
+        when the reply was read off the port, lastRequest the request it
+        answers, or answered had it come."""
+        message, sent = self.inFlight[0]
+        self.lastRequest = message
+        deadline = sent + self.timeoutSecs
+        while not self.lines:
+            now = monotonic()
+            if now >= deadline:
+                self.inFlight.pop(0)
+                self.timeouts += 1
+                self.__dropLate(now + self.graceSecs)
+                return None
+            self.__readWaiting(deadline - now)
+
+        self.inFlight.pop(0)
+        line, self.lastReceived = self.lines.pop(0)
+        self.lastLatency = self.lastReceived - sent
+        self.latency.record(self.lastLatency)
+        return line
+
+    def __dropLate(self, until):
+        "reads until then, dropping whatever arrives, the late reply most likely among it"
+        now = monotonic()
+        while now < until:
+            self.__readWaiting(until - now)
+            now = monotonic()
+        self.lateLines += len(self.lines)
+        self.lines = []
+        self.serial_port.flushInput()
+        self.buffer = ''
+
+    def call(self, message):
+        self.send(message)
+        reply = self.receive()
+        if reply is None:
+            return ''
+        return reply
+
+    def __str__(self):
+        elapsed = monotonic() - self.started
+        return "samples/s[%.1f] timeouts[%s] lateLines[%s] latency %s" % (
+            self.latency.count / elapsed if elapsed > 0 else 0.0, self.timeouts, self.lateLines, self.latency)
+
+
 class Kettler():
-    def __init__(self, serial_port, debug=False):
+    def __init__(self, serial_port, debug=False, timeoutMillis=RPC_TIMEOUT_MILLIS):
         self.serial_port = serial_port
         self.debug = debug
         self.GET_ID = "ID\r\n"
         self.GET_STATUS = "ST\r\n"
+        self.SET_POWER = "PW%d\r\n"  # replies with the status, like ST
+        self.rpcEngine = KettlerRpc(serial_port, timeoutMillis)
+        self.lastStatusLine = None
+        self.badLines = 0
+        self.emptyLines = 0
+        self.duplicates = 0
+        self.lastReply = None  # when the last good status arrived, a repeat of the one before included
+        self.targetSequence = 0
+        self.commandedPower = None  # the last target the bike reported as destPower
+        self.pendingTarget = None  # (watts, time received from the head unit), set but not yet reported
+        # from the head unit sending a target power to the bike reporting it as destPower
+        self.targetLatency = LatencyHistogram()
 
     def rpc(self, message):
-        self.serial_port.write(message)
-        self.serial_port.flush()
-        response = self.serial_port.readline().rstrip()  # rstrip trims trailing whitespace
-        return response
+        return self.rpcEngine.call(message)
 
     def getId(self):
         return self.rpc(self.GET_ID)
 
     def readModel(self):
+        """Asks for the status once, returning a PowerModel, or None for a bad
+        or missing reply or one identical to the last, see readModels"""
         statusLine = self.rpc(self.GET_STATUS)
-        # heartRate cadence speed distanceInFunnyUnits destPower energy timeElapsed realPower
-        # 000 052 095 000 030 0001 00:12 030
+        if not statusLine:
+            self.emptyLines += 1
+            self.lastStatusLine = statusLine
+            return None
+        if self.__isRepeat(statusLine):
+            return None
+        return self.__newModel(statusLine)
 
-        segments = statusLine.split()
-        if len(segments) == 8:
-            cadence = int(segments[1])
-            destPower = int(segments[4])
-            realPower = int(segments[7])
-            if self.debug and destPower != realPower:
-                print("Difference: destPower: %s  realPower: %s" % (destPower, realPower))
-            return PowerModel(realPower, cadence)
-        else:
+    def readModels(self, scheduler=None, targetPower=None):
+        """Polls the bike forever, yielding a PowerModel, or None for a bad or
+        missing reply, per status request.  The bike only updates its status
+        about once a second, so a reply identical to the last good one is
+        counted in duplicates and skipped rather than parsed and yielded.
+        Missing or empty replies are counted in emptyLines, ones that don't
+        parse in badLines.  lastReply is when the last good reply arrived,
+        skipped or not, so a bike that is there but idle isn't taken for one
+        that has gone silent.
+
+        A repeat is the whole line rather than the bike's elapsed time
+        alone: the reply to setting the power reports the new destPower
+        within the same second, and elapsed time stands still while the
+        rider isn't pedalling, when heart rate still changes.  Comparing
+        the line costs no more than comparing the time sliced out of it.
+
+        With a scheduler (see PollScheduler), requests go out when it says and
+        it learns the round trip time, otherwise they go back to back.  When
+        the next request is already due, it is written before the reply to the
+        previous one is parsed.
+
+        With targetPower (see TargetPower), a new target from the head unit
+        is set on the bike in place of the next status request, and the time
+        until the bike reports it as destPower goes into targetLatency.  A
+        target only counts as set once the bike reports it; if the reply to
+        setting it is missing or bad, it is set again with the next request."""
+        self.__sendRequest(targetPower)
+        while True:
+            statusLine = self.rpcEngine.receive()
+            if scheduler is not None and statusLine is not None:
+                scheduler.recordRoundTrip(self.rpcEngine.lastLatency)
+
+            due = scheduler.nextRequestTime(monotonic()) if scheduler is not None else 0
+            if self.rpcEngine.lastRequest.startswith('PW') and parse_status(statusLine or '') is None:
+                self.__retryTarget()
+
+            requested = due <= monotonic()
+            if requested:
+                self.__sendRequest(targetPower)
+
+            if not statusLine:
+                self.emptyLines += 1
+                self.lastStatusLine = statusLine
+                yield None
+            elif not self.__isRepeat(statusLine):
+                yield self.__newModel(statusLine)
+
+            if not requested:
+                delay = due - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.__sendRequest(targetPower)
+
+    def __isRepeat(self, statusLine):
+        "whether statusLine is the last good status again, counting it if so"
+        if statusLine != self.lastStatusLine:
+            return False
+        self.duplicates += 1
+        self.lastReply = self.rpcEngine.lastReceived
+        return True
+
+    def __newModel(self, statusLine):
+        "parses a new status, noting when it arrived and whether it reports the pending target"
+        model = self.parseStatus(statusLine)
+        # only a good reply is compared with, so a bad one repeated is counted again
+        self.lastStatusLine = statusLine if model is not None else None
+        if model is not None:
+            model.timestamp = self.lastReply = self.rpcEngine.lastReceived
+            if self.pendingTarget is not None and model.destPower == self.pendingTarget[0]:
+                self.targetLatency.record(model.timestamp - self.pendingTarget[1])
+                self.commandedPower = self.pendingTarget[0]
+                self.pendingTarget = None
+        return model
+
+    def __sendRequest(self, targetPower):
+        "sets the power if there's a new target for the bike, otherwise asks for the status"
+        if targetPower is not None:
+            sequence, watts, received = targetPower.read()
+            if sequence != self.targetSequence:
+                self.targetSequence = sequence
+                watts = max(MIN_POWER, min(MAX_POWER, int(round(watts / float(POWER_STEP))) * POWER_STEP))
+                if watts != self.commandedPower:
+                    if self.debug:
+                        print("Setting power to [%s]" % watts)
+                    self.pendingTarget = (watts, received)
+                    self.rpcEngine.send(self.SET_POWER % watts)
+                    return
+        self.rpcEngine.send(self.GET_STATUS)
+
+    def __retryTarget(self):
+        "forgets the target that didn't get a good reply, so that the latest target is set again"
+        if self.debug:
+            print("No good reply to setting power, setting it again")
+        self.commandedPower = None
+        self.pendingTarget = None
+        self.targetSequence = None
+
+    def parseStatus(self, statusLine):
+        model = parse_status(statusLine)
+        if model is None:
+            self.badLines += 1
             print("Received bad status string from Kettler: [%s]" % statusLine)
-            return None
+        elif self.debug and model.destPower != model.power:
+            print("Difference: destPower: %s  realPower: %s" % (model.destPower, model.power))
+        return model
 
     def close(self):
         close_safely(self.serial_port)
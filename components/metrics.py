@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""Serves the adapter's timings and error counts over HTTP, in the
+Prometheus text format, for scraping.
+
+Everything is read from the counters and histograms the ANT and Kettler
+loops keep anyway, and only when a scrape comes in, so serving metrics
+costs those loops nothing."""
+
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def histogram_lines(name, help, histogram):
+    """a LatencyHistogram as a Prometheus histogram in seconds.  Its last
+    bucket holds everything above the range, so is only reported as +Inf."""
+    lines = ["# HELP %s %s" % (name, help),
+             "# TYPE %s histogram" % name]
+    seen = 0
+    for bucket, n in enumerate(histogram.counts[:-1]):
+        seen += n
+        lines.append('%s_bucket{le="%.6g"} %d' % (name, histogram.bucketLimit(bucket), seen))
+    lines.append('%s_bucket{le="+Inf"} %d' % (name, histogram.count))
+    lines.append("%s_sum %.6f" % (name, histogram.total))
+    lines.append("%s_count %d" % (name, histogram.count))
+    return lines
+
+
+def metric_lines(name, type, help, value):
+    return ["# HELP %s %s" % (name, help),
+            "# TYPE %s %s" % (name, type),
+            "%s %s" % (name, value)]
+
+
+def render(antWriter, kettler=None):
+    "the metrics page for the writer, and the Kettler feeding it if there is one"
+    ant = antWriter.ant
+    txStats = antWriter.txStats
+    sequence, model = antWriter.models.read()
+    framer = ant.framer
+
+    lines = []
+    lines += histogram_lines("kettler_ant_tx_interval_seconds", "Time between event_tx from the ANT device.",
+                             txStats.intervals)
+    lines += histogram_lines("kettler_ant_tx_wait_seconds", "Time spent in wait_tx waiting for event_tx.",
+                             ant.txWait)
+    lines += metric_lines("kettler_ant_tx_missed_slots_total", "counter",
+                          "Channel periods with no event_tx seen.", txStats.missedSlots)
+    lines += metric_lines("kettler_ant_sync_losses_total", "counter",
+                          "Bytes skipped looking for an ANT sync byte.", framer.sync_losses if framer else 0)
+    lines += metric_lines("kettler_ant_checksum_errors_total", "counter",
+                          "ANT frames with a bad checksum.", framer.checksum_errors if framer else 0)
+    lines += metric_lines("kettler_ant_unknown_messages_total", "counter",
+                          "ANT messages not in the message definitions.", ant.unknown_messages)
+    lines += metric_lines("kettler_ant_repeated_samples_total", "counter",
+                          "Pages sent again for want of a new sample.", antWriter.repeatedSamples)
+    lines += metric_lines("kettler_ant_power_watts", "gauge", "Power being broadcast.", model.power)
+    lines += metric_lines("kettler_ant_cadence_rpm", "gauge", "Cadence being broadcast.", model.cadence)
+
+    if kettler is not None:
+        rpc = kettler.rpcEngine
+        lines += histogram_lines("kettler_rpc_latency_seconds", "Time from a Kettler request to its reply.",
+                                 rpc.latency)
+        lines += metric_lines("kettler_rpc_timeouts_total", "counter",
+                              "Kettler requests with no reply in time.", rpc.timeouts)
+        lines += metric_lines("kettler_bad_lines_total", "counter",
+                              "Kettler status replies that could not be parsed.", kettler.badLines)
+        lines += metric_lines("kettler_empty_lines_total", "counter",
+                              "Kettler status requests with a missing or empty reply.", kettler.emptyLines)
+        lines += metric_lines("kettler_duplicate_lines_total", "counter",
+                              "Kettler status replies identical to the one before.", kettler.duplicates)
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(threading.Thread):
+    """Serves render(antWriter, kettler) at /metrics, on its own thread.
+    Binds to localhost unless told otherwise."""
+
+    def __init__(self, antWriter, kettler=None, port=9105, address='127.0.0.1'):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.setName("metrics")
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = render(antWriter, kettler).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', CONTENT_TYPE)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass  # a scrape every few seconds would drown everything else out
+
+        self.server = HTTPServer((address, port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,14 @@
+import os
+import pty
+import tty
+
+
+def open_raw_pty():
+    """Returns (master fd, slave fd, slave device name) for a new
+    pseudo-terminal in raw mode, so bytes pass through it unchanged.  Keep
+    the slave fd open for as long as the terminal is needed, or the master
+    side sees a hangup whenever the device is closed."""
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
@@ -0,0 +1,171 @@
+import math
+
+try:
+    from time import monotonic
+except ImportError:  # python 2 has no monotonic clock, wall time is the best there is
+    from time import time as monotonic
+
+
+class TransmitStats:
+    "Tracks the interval between event_tx messages against the channel period"
+
+    def __init__(self, periodSecs):
+        self.periodSecs = periodSecs
+        self.lastEvent = None
+        self.events = 0
+        self.missedSlots = 0
+        self.jitterSumSquares = 0.0
+        self.maxJitter = 0.0
+        self.intervals = LatencyHistogram()
+
+    def record(self, t):
+        if self.lastEvent is not None:
+            interval = t - self.lastEvent
+            self.intervals.record(interval)
+            slots = max(1, int(round(interval / self.periodSecs)))
+            self.missedSlots += slots - 1
+            jitter = interval - slots * self.periodSecs
+            self.jitterSumSquares += jitter * jitter
+            self.maxJitter = max(self.maxJitter, abs(jitter))
+        self.lastEvent = t
+        self.events += 1
+
+    def rmsJitter(self):
+        if self.events < 2:
+            return 0.0
+        return (self.jitterSumSquares / (self.events - 1)) ** 0.5
+
+    def __str__(self):
+        return "events[%s] missedSlots[%s] jitter rms[%.1fms] max[%.1fms]" % (
+            self.events, self.missedSlots, self.rmsJitter() * 1000, self.maxJitter * 1000)
+
+
+class RunningStats:
+    "count, mean and max of a series of durations in seconds"
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, secs):
+        self.count += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def __str__(self):
+        return "count[%s] mean[%.1fms] max[%.1fms]" % (self.count, self.mean() * 1000, self.max * 1000)
+
+
+class PollScheduler:
+    """Decides when to send the next status request to the bike, so that the
+    reply lands just before the next ANT transmit slot.
+
+    The round trip time is learnt as a smoothed mean and deviation, as TCP
+    does for its retransmit timer, and the transmit phase comes from the
+    last event_tx recorded in txStats."""
+
+    def __init__(self, txStats, marginSecs=0.01, gain=0.125):
+        self.txStats = txStats
+        self.marginSecs = marginSecs
+        self.gain = gain
+        self.roundTrip = None
+        self.roundTripDeviation = 0.0
+
+    def recordRoundTrip(self, secs):
+        if self.roundTrip is None:
+            self.roundTrip = secs
+            self.roundTripDeviation = secs / 2
+        else:
+            self.roundTripDeviation += self.gain * (abs(secs - self.roundTrip) - self.roundTripDeviation)
+            self.roundTrip += self.gain * (secs - self.roundTrip)
+
+    def leadTime(self):
+        "how long before a slot to send the request"
+        return self.roundTrip + 2 * self.roundTripDeviation + self.marginSecs
+
+    def nextRequestTime(self, now):
+        "free runs, returning now, until both the round trip and the phase are known"
+        lastEvent = self.txStats.lastEvent
+        if self.roundTrip is None or lastEvent is None:
+            return now
+
+        period = self.txStats.periodSecs
+        lead = self.leadTime()
+        slots = max(1, int((now + lead - lastEvent) / period) + 1)
+        return lastEvent + slots * period - lead
+
+
+class LatencyHistogram:
+    """Fixed-size histogram of durations in seconds, with logarithmic
+    buckets so percentiles are accurate to within a bucket (about 12%)
+    anywhere from minSecs to maxSecs."""
+
+    def __init__(self, minSecs=0.0001, maxSecs=10.0, bucketsPerDecade=20):
+        self.minSecs = minSecs
+        self.bucketsPerDecade = bucketsPerDecade
+        self.counts = [0] * (int(math.ceil(math.log10(maxSecs / minSecs) * bucketsPerDecade)) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, secs):
+        if secs <= self.minSecs:
+            bucket = 0
+        else:
+            bucket = min(len(self.counts) - 1, int(math.log10(secs / self.minSecs) * self.bucketsPerDecade) + 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def bucketLimit(self, bucket):
+        "upper bound of a bucket"
+        return self.minSecs * 10 ** (float(bucket) / self.bucketsPerDecade)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                return min(self.bucketLimit(bucket), self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def __str__(self):
+        return "count[%s] p50[%.1fms] p95[%.1fms] p99[%.1fms] max[%.1fms]" % (
+            self.count, self.percentile(50) * 1000, self.percentile(95) * 1000,
+            self.percentile(99) * 1000, self.max * 1000)
+
+
+class StageLatencies:
+    """A LatencyHistogram per stage of a pipeline, and one end to end.
+    Each sample is recorded as the times it came out of each stage, so
+    len(stages) + 1 of them, the first being when it went in."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.histograms = [LatencyHistogram() for s in stages]
+        self.total = LatencyHistogram()
+
+    def record(self, stamps):
+        for i in range(len(self.stages)):
+            self.histograms[i].record(stamps[i + 1] - stamps[i])
+        self.total.record(stamps[-1] - stamps[0])
+
+    def __str__(self):
+        lines = ["%-20s %s" % (stage, histogram) for stage, histogram in zip(self.stages, self.histograms)]
+        lines.append("%-20s %s" % ("end to end", self.total))
+        return "\n".join(lines)
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+"""An ANT USB stick on a pseudo-terminal, for running the broadcasters
+without a dongle.
+
+It answers reset, capability, status and channel id requests, acknowledges
+channel configuration, and once a channel is open sends event_tx every
+channel period, recording the page that went out in each slot.  Open the
+terminal at AntStickEmulator.portName as if it were the stick:
+
+  stick = AntStickEmulator()
+  stick.start()
+  writer = PowerWriter(250, key, syncToEventTx=True, port=Serial(stick.portName, baudrate=57600, rtscts=1))
+"""
+
+import os
+import select
+import threading
+import time
+
+from ant_support import ant
+
+from components.pseudo_terminal import open_raw_pty
+from components.timing import RunningStats, monotonic
+
+RESPONSE_NO_ERROR = 0x00
+EVENT_TX = 0x03
+EVENT_TRANSFER_TX_COMPLETED = 0x05
+EVENT_CHANNEL_CLOSED = 0x07
+CHANNEL_IN_WRONG_STATE = 0x15
+CHANNEL_ID_NOT_SET = 0x18
+
+STATUS_UNASSIGNED = 0
+STATUS_ASSIGNED = 1
+STATUS_TRACKING = 3
+
+STARTUP_POWER_ON_RESET = 0x00
+
+# 8 channels and 3 networks, with extended messages, as on a USB2 stick
+CAPABILITIES = [8, 3, 0x00, 0xba, 0x36, 0x00]
+VERSION = 'AJK3.01EMU'
+
+
+def frame(id, data):
+    message = bytearray([0xa4, len(data), id] + list(data))
+    checksum = 0
+    for b in message:
+        checksum ^= b
+    message.append(checksum)
+    return message
+
+
+class Transmission:
+    "one channel period on an open channel: when it went out, and the page sent"
+    __slots__ = ('time', 'channel', 'data', 'fresh')
+
+    def __init__(self, time, channel, data, fresh):
+        self.time = time
+        self.channel = channel
+        self.data = data
+        # whether the host loaded this page since the last slot, rather than it being sent again
+        self.fresh = fresh
+
+
+class Channel:
+    def __init__(self, type, network):
+        self.type = type
+        self.network = network
+        self.deviceNumber = 0
+        self.deviceType = 0
+        self.transmissionType = 0
+        self.period = 8192
+        self.open = False
+        self.nextSlot = None
+        self.lastSlot = None
+        self.page = bytearray(8)
+        self.fresh = False
+        self.acknowledged = False
+
+
+class AntStickEmulator(threading.Thread):
+    """responseDelaySecs is added before every reply, to mimic a slow
+    stick or USB bridge"""
+
+    def __init__(self, responseDelaySecs=0.0):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.setName("ant-stick-emulator")
+        self.responseDelaySecs = responseDelaySecs
+        self.master, self.slave, self.portName = open_raw_pty()
+        self.buffer = bytearray()
+        self.channels = {}
+        self.networkKeys = {}
+        self.transmissions = []
+        self.resets = 0
+        self.checksumErrors = 0
+        # from each event_tx to the host loading the next page
+        self.reloadDelay = RunningStats()
+        self.running = False
+        self.reset()
+
+    def reset(self):
+        self.channels = {}
+        self.networkKeys = {}
+        self.resets += 1
+
+    def send(self, id, data):
+        if self.responseDelaySecs:
+            time.sleep(self.responseDelaySecs)
+        os.write(self.master, bytes(frame(id, data)))
+
+    def respond(self, channel, messageId, code=RESPONSE_NO_ERROR):
+        self.send(0x40, [channel, messageId, code])
+
+    def openChannels(self):
+        return [(c, channel) for c, channel in self.channels.items() if channel.open]
+
+    def run(self):
+        self.running = True
+        while self.running:
+            now = monotonic()
+            slots = [channel.nextSlot for c, channel in self.openChannels()]
+            wait = min(slots) - now if slots else 0.05
+            readable, writable, errored = select.select([self.master], [], [], max(0, min(wait, 0.05)))
+            if readable:
+                self.buffer += os.read(self.master, 4096)
+                self.handleFrames()
+            self.transmit(monotonic())
+
+    def stop(self):
+        self.running = False
+
+    def transmit(self, now):
+        for c, channel in self.openChannels():
+            if now < channel.nextSlot:
+                continue
+            self.transmissions.append(Transmission(now, c, bytes(channel.page), channel.fresh))
+            channel.fresh = False
+            channel.lastSlot = now
+            channel.nextSlot += channel.period / 32768.0
+            if channel.nextSlot < now:  # we were held up, keep the phase
+                channel.nextSlot += (int((now - channel.nextSlot) * 32768.0 / channel.period) + 1) * channel.period / 32768.0
+            if channel.acknowledged:
+                channel.acknowledged = False
+                self.respond(c, 0x01, EVENT_TRANSFER_TX_COMPLETED)
+            else:
+                self.respond(c, 0x01, EVENT_TX)
+
+    def handleFrames(self):
+        while True:
+            start = self.buffer.find(b'\xa4')
+            if start < 0:
+                del self.buffer[:]
+                return
+            del self.buffer[:start]
+            if len(self.buffer) < 4 or len(self.buffer) < self.buffer[1] + 4:
+                return
+            length = self.buffer[1]
+            message = self.buffer[:length + 4]
+            checksum = 0
+            for b in message[:-1]:
+                checksum ^= b
+            if checksum != message[-1]:
+                # not a frame after all, look for the next sync byte
+                self.checksumErrors += 1
+                del self.buffer[:1]
+                continue
+            del self.buffer[:length + 4]
+            self.handle(message[2], message[3:-1])
+
+    def handle(self, id, data):
+        if id == ant.ANT_Reset_System:
+            self.reset()
+            self.send(0x6f, [STARTUP_POWER_ON_RESET])
+        elif id == ant.ANT_Request_Message:
+            self.handleRequest(data[0], data[1])
+        elif id == ant.ANT_Set_Network:
+            self.networkKeys[data[0]] = bytes(data[1:9])
+            self.respond(data[0], id)
+        elif id in (ant.ANT_Enable_Ext_Msgs, ant.ANT_Lib_Config):
+            self.respond(0, id)
+        elif id == ant.ANT_Assign_Channel:
+            if data[0] in self.channels:
+                self.respond(data[0], id, CHANNEL_IN_WRONG_STATE)
+            else:
+                self.channels[data[0]] = Channel(data[1], data[2])
+                self.respond(data[0], id)
+        elif data and data[0] not in self.channels:
+            # everything else is for a channel, which must be assigned first
+            self.respond(data[0], id, CHANNEL_IN_WRONG_STATE)
+        else:
+            self.handleChannelMessage(self.channels[data[0]], id, data)
+
+    def handleChannelMessage(self, channel, id, data):
+        c = data[0]
+        if id == ant.ANT_Unassign_Channel:
+            if channel.open:
+                self.respond(c, id, CHANNEL_IN_WRONG_STATE)
+            else:
+                del self.channels[c]
+                self.respond(c, id)
+        elif id == ant.ANT_Set_Channel_ID:
+            channel.deviceNumber = data[1] | data[2] << 8
+            channel.deviceType = data[3]
+            channel.transmissionType = data[4]
+            self.respond(c, id)
+        elif id == ant.ANT_Set_Channel_Period:
+            channel.period = data[1] | data[2] << 8
+            self.respond(c, id)
+        elif id == ant.ANT_Open_Channel:
+            if channel.open:
+                self.respond(c, id, CHANNEL_IN_WRONG_STATE)
+            elif channel.deviceNumber == 0 and channel.type == 0x10:
+                self.respond(c, id, CHANNEL_ID_NOT_SET)
+            else:
+                channel.open = True
+                channel.nextSlot = monotonic() + channel.period / 32768.0
+                self.respond(c, id)
+        elif id == ant.ANT_Close_Channel:
+            if not channel.open:
+                self.respond(c, id, CHANNEL_IN_WRONG_STATE)
+            else:
+                channel.open = False
+                self.respond(c, id)
+                self.respond(c, 0x01, EVENT_CHANNEL_CLOSED)
+        elif id in (ant.ANT_Broadcast_Data, ant.ANT_Acknowledged_Data):
+            if channel.lastSlot is not None and not channel.fresh:
+                self.reloadDelay.record(monotonic() - channel.lastSlot)
+            channel.page = bytearray(data[1:9])
+            channel.fresh = True
+            channel.acknowledged = id == ant.ANT_Acknowledged_Data
+        else:
+            # frequency, search timeouts and the like change nothing here
+            self.respond(c, id)
+
+    def handleRequest(self, c, requested):
+        if requested == ant.ANT_Capabilities:
+            self.send(requested, CAPABILITIES)
+        elif requested == ant.ANT_Version:
+            self.send(requested, bytearray(VERSION.encode('ascii')) + bytearray(1))
+        elif requested == ant.ANT_Channel_Status:
+            channel = self.channels.get(c)
+            if channel is None:
+                self.send(requested, [c, STATUS_UNASSIGNED])
+            else:
+                state = STATUS_TRACKING if channel.open else STATUS_ASSIGNED
+                self.send(requested, [c, channel.type & 0xf0 | (channel.network & 0x3) << 2 | state])
+        elif requested == ant.ANT_Channel_ID and c in self.channels:
+            channel = self.channels[c]
+            self.send(requested, [c, channel.deviceNumber & 0xff, channel.deviceNumber >> 8,
+                                  channel.deviceType, channel.transmissionType])
+        else:
+            self.respond(c, ant.ANT_Request_Message, CHANNEL_IN_WRONG_STATE)
+
+    def receiveAcknowledged(self, channel, data):
+        "passes on acknowledged data as if a head unit had sent it to the channel"
+        self.send(ant.ANT_Acknowledged_Data, [channel] + list(data))
+
+    def transmitted(self, channel=0):
+        "the transmissions on a channel so far"
+        return [t for t in self.transmissions if t.channel == channel]
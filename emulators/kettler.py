@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""A Kettler bike on a pseudo-terminal, for driving the input side without
+one.
+
+It answers ID and ST, and PW <watts> as the bike does, with a status line,
+after a configurable latency and jitter.  Replies can be dropped or
+replaced by garbage at random, or withheld altogether for set stretches of
+time.  Power and cadence follow a scripted Profile, and the bike's status
+only changes once a second, as on the real thing:
+
+  bike = KettlerEmulator(Profile.intervals(4, 30, 300, 60, 120), latencySecs=0.02, garbageRate=0.01)
+  bike.start()
+  kettler = Kettler(Serial(bike.portName, baudrate=57600, timeout=1))
+
+Random choices come from a seeded generator, so a run can be repeated.
+"""
+
+import os
+import random
+import select
+import threading
+
+from components.pseudo_terminal import open_raw_pty
+from components.timing import monotonic
+
+ID_REPLY = "SEMU0001"
+
+
+class Profile:
+    """Power and cadence over time, as segments of (seconds, power from,
+    power to, cadence) with power moving linearly across each.  Profiles
+    add together to play one after the other, and hold their last value
+    once they have run out, unless they loop."""
+
+    def __init__(self, segments, loop=False):
+        self.segments = segments
+        self.loop = loop
+        self.duration = sum([s[0] for s in segments])
+
+    def __add__(self, other):
+        return Profile(self.segments + other.segments, self.loop)
+
+    def at(self, t):
+        "(power, cadence) t seconds in"
+        if self.loop and self.duration > 0:
+            t %= self.duration
+        for secs, fromPower, toPower, cadence in self.segments:
+            if t < secs:
+                return int(fromPower + (toPower - fromPower) * t / secs), cadence
+            t -= secs
+        secs, fromPower, toPower, cadence = self.segments[-1]
+        return toPower, cadence
+
+    @staticmethod
+    def steady(secs, power, cadence=85):
+        return Profile([(secs, power, power, cadence)])
+
+    @staticmethod
+    def ramp(secs, fromPower, toPower, cadence=85):
+        return Profile([(secs, fromPower, toPower, cadence)])
+
+    @staticmethod
+    def sprint(secs, power, cadence=115):
+        return Profile([(secs, power, power, cadence)])
+
+    @staticmethod
+    def intervals(repeats, onSecs, onPower, offSecs, offPower, onCadence=95, offCadence=80):
+        return Profile([(onSecs, onPower, onPower, onCadence), (offSecs, offPower, offPower, offCadence)] * repeats)
+
+
+class KettlerEmulator(threading.Thread):
+    """latencySecs is the least time to reply, with up to jitterSecs more at
+    random.  garbageRate and dropoutRate are the chances that a reply is
+    noise or never comes, and silences lists (start, seconds) stretches,
+    from when the emulator starts, when nothing is answered at all."""
+
+    def __init__(self, profile, latencySecs=0.02, jitterSecs=0.0, garbageRate=0.0, dropoutRate=0.0,
+                 silences=(), seed=1):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.setName("kettler-emulator")
+        self.profile = profile
+        self.latencySecs = latencySecs
+        self.jitterSecs = jitterSecs
+        self.garbageRate = garbageRate
+        self.dropoutRate = dropoutRate
+        self.silences = silences
+        self.random = random.Random(seed)
+        self.master, self.slave, self.portName = open_raw_pty()
+        self.buffer = ''
+        self.replies = []  # (due, line), in order
+        self.destPower = None  # set by PW, otherwise the profile's power
+        self.requests = 0
+        self.garbageSent = 0
+        self.dropped = 0
+        self.running = False
+        self.started = None
+
+    def statusLine(self, now):
+        "the bike only updates its status once a second"
+        seconds = int(now - self.started)
+        power, cadence = self.profile.at(seconds)
+        if self.destPower is not None:
+            power = self.destPower
+        speed = cadence * 36 // 10  # 0.1km/h
+        distance = (seconds * speed // 3600) % 1000  # 100m units
+        energy = seconds * power // 4184
+        return "%03d %03d %03d %03d %03d %04d %02d:%02d %03d" % (
+            0, cadence, speed, distance, power, energy, seconds // 60 % 100, seconds % 60, power)
+
+    def garbage(self):
+        return ''.join([chr(self.random.randint(33, 126)) for i in range(self.random.randint(1, 40))])
+
+    def silent(self, now):
+        t = now - self.started
+        for start, secs in self.silences:
+            if start <= t < start + secs:
+                return True
+        return False
+
+    def reply(self, now, line):
+        if self.silent(now) or self.random.random() < self.dropoutRate:
+            self.dropped += 1
+            return
+        if self.random.random() < self.garbageRate:
+            self.garbageSent += 1
+            line = self.garbage()
+        due = now + self.latencySecs + self.random.random() * self.jitterSecs
+        if self.replies:
+            due = max(due, self.replies[-1][0])  # one serial line, replies can't overtake
+        self.replies.append((due, line + "\r\n"))
+
+    def handle(self, now, command):
+        self.requests += 1
+        if command == "ID":
+            self.reply(now, ID_REPLY)
+        elif command == "ST":
+            self.reply(now, self.statusLine(now))
+        elif command.startswith("PW"):
+            try:
+                self.destPower = int(command[2:])
+            except ValueError:
+                return self.reply(now, "ERROR")
+            self.reply(now, self.statusLine(now))
+        else:
+            self.reply(now, "ERROR")
+
+    def run(self):
+        self.running = True
+        self.started = monotonic()
+        while self.running:
+            now = monotonic()
+            wait = self.replies[0][0] - now if self.replies else 0.05
+            readable, writable, errored = select.select([self.master], [], [], max(0, min(wait, 0.05)))
+            now = monotonic()
+            if readable:
+                self.buffer += os.read(self.master, 4096).decode('latin-1')
+                while '\n' in self.buffer:
+                    command, self.buffer = self.buffer.split('\n', 1)
+                    self.handle(now, command.strip())
+            while self.replies and self.replies[0][0] <= now:
+                due, line = self.replies.pop(0)
+                os.write(self.master, line.encode('latin-1'))
+
+    def stop(self):
+        self.running = False
@@ -9,13 +9,47 @@ from threading import Thread
 from components.ant_writer import *
 from components import kettler_serial
 from components.ant import PowerModel
+from components.timing import PollScheduler, monotonic
+from components.ant_broadcaster import PowerChannel, HeartRateChannel, SpeedCadenceChannel, FitnessEquipmentChannel
+from components import capture
+from components import discovery
+from components.metrics import MetricsServer
+from ant_support import ant
 
 MAX_TIME_BETWEEN_UPDATES = 5000
-TRANSMIT_INTERVAL_MILLIS = 250
+MAX_SILENCE_SECS = 10  # without a good status from the Kettler, before it is restarted
+TRANSMIT_INTERVAL_MILLIS = 250  # only used when not syncing to event_tx
+SYNC_TO_EVENT_TX = True
+# what the bike broadcasts as: 'power', a power meter, or 'trainer', an FE-C trainer head units can set the power of
+PROFILE = os.getenv('KETTLER_ANT_PROFILE', 'power')
+
+
+def channelTypesFor(profile):
+    "the profiles to broadcast, each on its own channel of the one device, the main one first"
+    if profile == 'trainer':
+        return [FitnessEquipmentChannel]
+    return [PowerChannel]  # add HeartRateChannel and SpeedCadenceChannel to publish those too
+
+
+def writerChannelTypes(channelTypes):
+    "channelTypes as PowerWriter takes them, None for the single power channel"
+    return channelTypes if channelTypes != [PowerChannel] else None
+
+
+CHANNEL_TYPES = channelTypesFor(PROFILE)
 MAX_CONSECUTIVE_BAD_LINES = 100
 MAX_CONSECUTIVE_EMPTY_LINES = 5
 DEBUG = False
 
+# path of a log of all serial traffic to the ANT device and the Kettler, for replay with components.capture
+CAPTURE_PATH = os.getenv('KETTLER_ANT_CAPTURE')
+
+# where the ports and settings of the devices last found are kept, to try first on the next start
+STATE_PATH = os.getenv('KETTLER_ANT_STATE', discovery.STATE_PATH)
+
+# port to serve Prometheus metrics on, at localhost:<port>/metrics
+METRICS_PORT = os.getenv('KETTLER_ANT_METRICS_PORT')
+
 ANT_PLUS_NETWORK_KEY_STRING = os.getenv('ANT_PLUS_NETWORK_KEY', "00 00 00 00 00 00 00 00")
 ANT_PLUS_NETWORK_KEY = [int(i, 16) for i in ANT_PLUS_NETWORK_KEY_STRING.split()]
 if sum(ANT_PLUS_NETWORK_KEY) == 0:
@@ -29,7 +63,7 @@ elif DEBUG:
 
 
 def quit_on_problem(reason, antWriter):
-    print("WATCHDOG QUIT TRIGGERED because ANT+ writer thread %s. Letting it close, then exiting..." % reason)
+    print("WATCHDOG QUIT TRIGGERED because %s. Letting it close, then exiting..." % reason)
     antWriter.stop()
     sleep(1)
     printStackTraces()
@@ -58,14 +92,18 @@ def printStackTraces():
     print >> sys.stderr, "\n*** STACKTRACE - END ***\n"
 
 
-def runWatchdog(antWriter):
+def runWatchdog(antWriter, kettler=None, inputThread=None):
+    """Returns once antWriter has died, stopped or stalled.  With kettler and
+    inputThread, the thread reading from it, also once that thread has
+    stopped or the bike has sent no good status for MAX_SILENCE_SECS."""
+    started = monotonic()
     watchdogRunning = True
     while watchdogRunning:
         sleep(1)
 
         if antWriter.died:
             watchdogRunning = False
-            quit_on_problem("died", antWriter)
+            quit_on_problem("ANT+ writer thread died", antWriter)
 
         if not antWriter.running:
             watchdogRunning = False
@@ -74,14 +112,39 @@ def runWatchdog(antWriter):
         millisSinceLastUpdate = (currentTimeMillis() - antWriter.lastUpdate)
         if millisSinceLastUpdate > MAX_TIME_BETWEEN_UPDATES:
             watchdogRunning = False
-            quit_on_problem("made no progress for %sms" % millisSinceLastUpdate, antWriter)
+            quit_on_problem("ANT+ writer thread made no progress for %sms" % millisSinceLastUpdate, antWriter)
+
+        if inputThread is not None and not inputThread.is_alive():
+            watchdogRunning = False
+            quit_on_problem("Kettler input thread stopped", antWriter)
+
+        if kettler is not None:
+            secsSinceLastReply = monotonic() - (kettler.lastReply or started)
+            if secsSinceLastReply > MAX_SILENCE_SECS:
+                watchdogRunning = False
+                quit_on_problem("Kettler sent no status for %.1fs" % secsSinceLastReply, antWriter)
 
 
-def readFromKettler(antWriter, kettler, debug):
-    while True:
-        model = kettler.readModel()
-        if model is not None:
-            antWriter.updateModel(model)
+def readFromKettler(antWriter, kettler, debug, started=None):
+    """started is when the adapter started, on the monotonic clock, to
+    report how long it took to broadcast the bike's first sample"""
+    # time requests so that each reply arrives just before an ANT transmit slot
+    try:
+        scheduler = PollScheduler(antWriter.txStats)
+        lastStats = currentTimeMillis()
+        for model in kettler.readModels(scheduler, antWriter.targetPower):
+            if model is not None:
+                antWriter.updateModel(model)
+            if started is not None and antWriter.firstBroadcast is not None:
+                print("First sample broadcast [%.2fs] after starting" % (antWriter.firstBroadcast - started))
+                started = None
+            if currentTimeMillis() - lastStats > STATS_INTERVAL_MILLIS:
+                print("Kettler rpc: %s" % kettler.rpcEngine)
+                print("Target power from head unit to bike: %s" % kettler.targetLatency)
+                lastStats = currentTimeMillis()
+    except Exception as e:
+        print("Reading from the Kettler failed with exception: %s" % str(e))
+        antWriter.stop()
 
 
 def detectInterrupt(antWriter):
@@ -132,7 +195,7 @@ def readFromStdin(antWriter, debug):
         antWriter.stop()
 
 
-def runMain(antWriter, kettler):
+def runMain(antWriter, kettler, started=None):
     print("Creating worker threads")
 
     # this thread reads from the in-memory power model and writes to Ant+
@@ -140,16 +203,16 @@ def runMain(antWriter, kettler):
     antWriteThread.setDaemon(True)
     antWriteThread.setName("ant-write")
 
-    # this thread watches that progress continues to be made
-    watchdogThread = Thread(target=runWatchdog, args=(antWriter,))
-    watchdogThread.setDaemon(True)
-    watchdogThread.setName("watchdog")
-
     # this thread reads input from the Kettler and pushes it into the power model
-    inputThread = Thread(target=readFromKettler, args=(antWriter, kettler, DEBUG,))
+    inputThread = Thread(target=readFromKettler, args=(antWriter, kettler, DEBUG, started))
     inputThread.setDaemon(True)
     inputThread.setName("kettler-to-model")
 
+    # this thread watches that progress continues to be made
+    watchdogThread = Thread(target=runWatchdog, args=(antWriter, kettler, inputThread))
+    watchdogThread.setDaemon(True)
+    watchdogThread.setName("watchdog")
+
     # this thread checks for Ctrl-C and shuts down
     interruptThread = Thread(target=detectInterrupt, args=(antWriter,))
     interruptThread.setDaemon(True)
@@ -165,18 +228,42 @@ def runMain(antWriter, kettler):
 
 
 if __name__ == "__main__":
+    started = monotonic()
     antWriter = None
+    captureLog = None
     try:
+        found = discovery.discover(STATE_PATH, DEBUG)
+        if discovery.ANT not in found:
+            raise Exception("No ANT device found")
+        if discovery.KETTLER not in found:
+            raise Exception("No Kettler found")
+
+        antPort = discovery.open_ant(found[discovery.ANT])
+        if CAPTURE_PATH:
+            print("Capturing serial traffic to [%s]" % CAPTURE_PATH)
+            captureLog = capture.CaptureLog(CAPTURE_PATH, {'channelTypes': [t.__name__ for t in CHANNEL_TYPES]})
+            antPort = capture.CapturingSerial(antPort, captureLog, capture.ANT_PORT)
+
         print("Creating Ant writer...")
         antWriter = PowerWriter(transmitIntervalMillis=TRANSMIT_INTERVAL_MILLIS,
                                 networkKey=ANT_PLUS_NETWORK_KEY,
-                                debug=DEBUG)
+                                debug=DEBUG,
+                                syncToEventTx=SYNC_TO_EVENT_TX,
+                                port=antPort,
+                                channelTypes=writerChannelTypes(CHANNEL_TYPES))
 
         print("Creating Kettler interface...")
-        kettler = kettler_serial.find_kettler_usb(DEBUG)
+        kettler = kettler_serial.open_kettler_usb(found[discovery.KETTLER].port, DEBUG)
+        if captureLog:
+            kettler.serial_port = kettler.rpcEngine.serial_port = capture.CapturingSerial(
+                kettler.serial_port, captureLog, capture.KETTLER_PORT)
         print("Found Kettler at [%s]" % kettler.getId())
 
-        runMain(antWriter, kettler)
+        if METRICS_PORT:
+            print("Serving metrics at [http://localhost:%s/metrics]" % METRICS_PORT)
+            MetricsServer(antWriter, kettler, port=int(METRICS_PORT)).start()
+
+        runMain(antWriter, kettler, started)
     except KeyboardInterrupt:
         if antWriter:
             antWriter.stop()
@@ -188,6 +275,8 @@ if __name__ == "__main__":
     finally:
         if antWriter:
             antWriter.stop()
+        if captureLog:
+            captureLog.close()
 
     if DEBUG:
         print("Finished main")
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+"""Runs a room of bikes: one worker process per Kettler and ANT device
+pair, restarted on its own if it fails, with their status summed up.
+
+  kettler_gym_supervisor.py gym.json
+
+gym.json pairs each bike with an ANT device.  A bike is given by the ID it
+reports or by its serial port, an ANT device by its serial port, ideally a
+stable name from /dev/serial/by-id:
+
+  {
+    "log_dir": "/var/log/kettler",
+    "pairs": [
+      {"name": "bike1", "kettler": "SF1B2345", "ant": "/dev/serial/by-id/usb-Dynastream_ANT_USB-m_1-if00"},
+      {"name": "bike2", "kettler": "/dev/ttyUSB3", "ant": "/dev/ttyANT1", "device_number_base": 20000,
+       "profile": "trainer"}
+    ]
+  }
+
+Each pair broadcasts with its own device numbers, from device_number_base
+or else DEVICE_NUMBER_BASE plus 256 for each pair before it.  A bike given
+by ID is looked for again before each restart, in case it has come back on
+another port, among the ports no other pair uses.  A pair broadcasts as
+its profile, 'power' or 'trainer', or else as KETTLER_ANT_PROFILE says.
+The status of each pair gives the age of the last new sample from its
+bike, flagged STALLED once that is older than the watchdog's
+MAX_SILENCE_SECS.  With log_dir, each worker writes its output to
+<name>.log there.  The network key comes from ANT_PLUS_NETWORK_KEY, as
+for kettler_ant_adapter.py.
+"""
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+from threading import Thread
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from serial import Serial
+
+import kettler_ant_adapter as adapter
+from ant_support import ant
+from components import kettler_serial
+from components.ant_broadcaster import DEVICE_NUMBER_BASE
+from components.ant_writer import PowerWriter
+from components.timing import monotonic
+
+STATUS_INTERVAL_SECS = 5
+SUMMARY_INTERVAL_SECS = 30
+MIN_RESTART_DELAY_SECS = 1
+MAX_RESTART_DELAY_SECS = 60
+HEALTHY_RUN_SECS = 60  # a worker that ran this long starts over with the shortest restart delay
+ANT_BAUDRATE = 115200
+
+
+def open_ant_port(name, baudrate=None):
+    if baudrate is None:
+        try:
+            return ant.open_serial(name)
+        except KeyError:  # not one of the usual names
+            baudrate = ANT_BAUDRATE
+    return Serial(name, baudrate=baudrate, rtscts=1)
+
+
+def reportStatus(name, antWriter, kettler, statusQueue):
+    while True:
+        sequence, model = antWriter.models.read()
+        statusQueue.put((name, {'pid': os.getpid(),
+                                'time': time.time(),
+                                'power': model.power,
+                                'sampleAge': monotonic() - model.timestamp,
+                                'cadence': model.cadence,
+                                'events': antWriter.txStats.events,
+                                'missedSlots': antWriter.txStats.missedSlots,
+                                'timeouts': kettler.rpcEngine.timeouts,
+                                'badLines': kettler.badLines}))
+        time.sleep(STATUS_INTERVAL_SECS)
+
+
+def runPair(pair, statusQueue, logDir):
+    "the worker process for one pair, which only returns if something went wrong"
+    if logDir:
+        log = open(os.path.join(logDir, pair['name'] + '.log'), 'a', 1)
+        sys.stdout = sys.stderr = log
+
+    if 'profile' in pair:
+        channelTypes = adapter.channelTypesFor(pair['profile'])
+    else:
+        channelTypes = adapter.CHANNEL_TYPES
+    print("Starting [%s] with Kettler at [%s] and ANT device at [%s], broadcasting as [%s]" % (
+        pair['name'], pair['kettler_port'], pair['ant'], ", ".join([t.__name__ for t in channelTypes])))
+    antWriter = PowerWriter(transmitIntervalMillis=adapter.TRANSMIT_INTERVAL_MILLIS,
+                            networkKey=adapter.ANT_PLUS_NETWORK_KEY,
+                            debug=adapter.DEBUG,
+                            syncToEventTx=adapter.SYNC_TO_EVENT_TX,
+                            port=open_ant_port(pair['ant'], pair.get('ant_baudrate')),
+                            channelTypes=adapter.writerChannelTypes(channelTypes),
+                            deviceNumberBase=pair['device_number_base'])
+    kettler = kettler_serial.open_kettler_usb(pair['kettler_port'], adapter.DEBUG)
+    print("Found Kettler at [%s]" % kettler.getId())
+
+    threads = [Thread(target=antWriter.start, name="ant-write"),
+               Thread(target=adapter.readFromKettler, args=(antWriter, kettler, adapter.DEBUG), name="kettler-to-model"),
+               Thread(target=reportStatus, args=(pair['name'], antWriter, kettler, statusQueue), name="status")]
+    for thread in threads:
+        thread.setDaemon(True)
+    threads[0].start()
+    antWriter.awaitRunning()
+    threads[1].start()
+    threads[2].start()
+
+    # returns once the writer or the Kettler has died, stopped or stalled
+    adapter.runWatchdog(antWriter, kettler, threads[1])
+    sys.exit(1)
+
+
+class PairSupervisor:
+    "starts one pair's worker process, and starts it again whenever it exits"
+
+    def __init__(self, pair, statusQueue, logDir):
+        self.pair = pair
+        self.statusQueue = statusQueue
+        self.logDir = logDir
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.restartDelay = MIN_RESTART_DELAY_SECS
+        self.nextStart = 0
+        self.status = None
+        self.others = []  # the supervisors of the other pairs
+
+    def start(self):
+        self.process = multiprocessing.Process(target=runPair, args=(self.pair, self.statusQueue, self.logDir),
+                                               name=self.pair['name'])
+        self.process.daemon = True
+        self.process.start()
+        self.started = time.time()
+
+    def check(self, now):
+        if self.process is not None and self.process.is_alive():
+            return
+        if self.process is not None:
+            print("[%s] exited with [%s], restarting in %ss" % (
+                self.pair['name'], self.process.exitcode, self.restartDelay))
+            if now - self.started > HEALTHY_RUN_SECS:
+                self.restartDelay = MIN_RESTART_DELAY_SECS
+            self.nextStart = now + self.restartDelay
+            self.restartDelay = min(self.restartDelay * 2, MAX_RESTART_DELAY_SECS)
+            self.process = None
+            self.status = None
+            self.restarts += 1
+        if now >= self.nextStart:
+            if self.restarts:
+                self.relocateKettler()
+            self.start()
+
+    def relocateKettler(self):
+        """finds a Kettler given by ID again, as it may be on another port after
+        reconnecting, without trying the ports of the other pairs"""
+        if self.pair['kettler'].startswith('/dev/'):
+            return
+        held = [self.pair['ant']]
+        for other in self.others:
+            held += [other.pair['ant'], other.pair['kettler_port']]
+        exclude = set(held + [os.path.realpath(p) for p in held])
+        port = kettler_serial.find_all_kettlers_usb(adapter.DEBUG, exclude=exclude).get(self.pair['kettler'])
+        if port is None:
+            print("[%s] Kettler [%s] wasn't found, trying [%s] again" % (
+                self.pair['name'], self.pair['kettler'], self.pair['kettler_port']))
+        elif port != self.pair['kettler_port']:
+            print("[%s] Kettler [%s] has moved from [%s] to [%s]" % (
+                self.pair['name'], self.pair['kettler'], self.pair['kettler_port'], port))
+            self.pair['kettler_port'] = port
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5)
+
+    def summary(self, now):
+        name = self.pair['name']
+        if self.process is None:
+            return "%-12s restarting in %.0fs, restarts[%s]" % (name, max(0, self.nextStart - now), self.restarts)
+        if self.status is None:
+            return "%-12s starting, pid[%s] restarts[%s]" % (name, self.process.pid, self.restarts)
+        s = self.status
+        flags = ""
+        if s['sampleAge'] > adapter.MAX_SILENCE_SECS:
+            flags += " STALLED"  # no new sample from the bike, which may only be idle
+        if now - s['time'] > 3 * STATUS_INTERVAL_SECS:
+            flags += " STALE"
+        return ("%-12s power[%4s] cadence[%3s] age[%.0fs] events[%s] missedSlots[%s] timeouts[%s] badLines[%s]"
+                " restarts[%s]%s") % (
+            name, s['power'], s['cadence'], s['sampleAge'], s['events'], s['missedSlots'], s['timeouts'],
+            s['badLines'], self.restarts, flags)
+
+
+def resolvePairs(pairs):
+    """fills in each pair's kettler_port and device_number_base, and returns
+    the pairs that could be resolved"""
+    antPorts = [p['ant'] for p in pairs]
+    exclude = set(antPorts + [os.path.realpath(p) for p in antPorts])
+    kettlers = kettler_serial.find_all_kettlers_usb(adapter.DEBUG, exclude=exclude)
+
+    for name in ant.find_ant_serial_ports():
+        if name not in exclude and os.path.realpath(name) not in exclude:
+            print("ANT device [%s] isn't paired with a bike" % name)
+    paired = set([p['kettler'] for p in pairs])
+    for kettlerId, port in sorted(kettlers.items()):
+        if kettlerId not in paired and port not in paired:
+            print("Kettler [%s] at [%s] isn't paired with an ANT device" % (kettlerId, port))
+
+    resolved = []
+    for i, pair in enumerate(pairs):
+        pair = dict(pair)
+        pair.setdefault('name', 'bike%s' % (i + 1))
+        pair.setdefault('device_number_base', (DEVICE_NUMBER_BASE + 256 * i) % 0xff00)
+        if pair['kettler'].startswith('/dev/'):
+            pair['kettler_port'] = pair['kettler']
+        elif pair['kettler'] in kettlers:
+            pair['kettler_port'] = kettlers[pair['kettler']]
+        else:
+            print("[%s] is for Kettler [%s], which wasn't found, so won't be started" % (pair['name'], pair['kettler']))
+            continue
+        resolved.append(pair)
+    return resolved
+
+
+def main(configPath):
+    with open(configPath) as f:
+        config = json.load(f)
+
+    statusQueue = multiprocessing.Queue()
+    supervisors = [PairSupervisor(pair, statusQueue, config.get('log_dir'))
+                   for pair in resolvePairs(config['pairs'])]
+    byName = dict([(s.pair['name'], s) for s in supervisors])
+    for supervisor in supervisors:
+        supervisor.others = [s for s in supervisors if s is not supervisor]
+    print("Supervising [%s] bikes" % len(supervisors))
+
+    lastSummary = time.time()
+    try:
+        while True:
+            now = time.time()
+            for supervisor in supervisors:
+                supervisor.check(now)
+
+            try:
+                update = statusQueue.get(timeout=1)
+                while True:
+                    name, status = update
+                    supervisor = byName[name]
+                    if supervisor.process is not None and status['pid'] == supervisor.process.pid:
+                        supervisor.status = status
+                    update = statusQueue.get_nowait()
+            except Empty:
+                pass
+
+            if now - lastSummary > SUMMARY_INTERVAL_SECS:
+                print("\n".join([s.summary(now) for s in supervisors]))
+                lastSummary = now
+    except KeyboardInterrupt:
+        print("Detected Ctrl-C, stopping all bikes")
+    finally:
+        for supervisor in supervisors:
+            supervisor.stop()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: %s gym.json" % sys.argv[0])
+        sys.exit(1)
+    main(sys.argv[1])